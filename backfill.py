@@ -0,0 +1,277 @@
+# Regenerate, render and diff the reports of all dated snapshots
+#
+# Finds every guild_data_[GUILD_]YYYYMMDD.json and lists_[GUILD_]YYYYMMDD.json
+# in a directory. The lists of every rating snapshot are regenerated from
+# the game info cache without requests to BGG, then all lists are
+# rendered and each is diffed with the previous snapshot of its guild.
+# Both steps run in a pool of processes sharing the cache read-only.
+# The outputs go to another directory, never over the published files,
+# and are named after the snapshots, a rerun replaces them:
+#
+#   lists_[GUILD_]YYYYMMDD.json
+#   output_[GUILD_]YYYYMMDD[_lang_style].html/txt
+#   topdiff_[GUILD_]YYYYMMDD_YYYYMMDD[_lang_style].html/txt
+
+import json
+import os
+import re
+
+import bgg_api
+import diff_toplists
+import game_cache
+from generate_lists import build_lists
+import list_specs
+import print_lists
+from ratings import DEFAULT_PRIOR_WEIGHT
+from reporting import (normalize_style, output_filename, run_batch,
+                       split_choices)
+
+SNAPSHOT_FILE = re.compile(r"^(guild_data|lists)_(?:(.+)_)?(\d{8})\.json$")
+
+
+def find_snapshots(directory):
+    """Returns: A dict guild (None for runs of a single guild) -> list of
+        (YYYYMMDD, guild_data file or None, lists file or None), oldest
+        first
+    """
+    found = dict()
+    for name in sorted(os.listdir(directory)):
+        match = SNAPSHOT_FILE.match(name)
+        if match is None:
+            continue
+        kind, guild, date_str = match.groups()
+        files = found.setdefault((guild, date_str), dict())
+        files[kind] = os.path.join(directory, name)
+    snapshots = dict()
+    for (guild, date_str), files in sorted(
+            found.items(), key=lambda x: (x[0][0] or "", x[0][1])):
+        snapshots.setdefault(guild, []).append(
+            (date_str, files.get("guild_data"), files.get("lists")))
+    return snapshots
+
+
+def label(guild, *dates):
+    return "_".join(([] if guild is None else [guild]) + list(dates))
+
+
+def regenerate(guild_data_file, lists_file, cache, b, n, s, specs,
+               prior_weight):
+    """Batch job: write the lists of guild_data_file to lists_file, game
+        infos missing from cache are not fetched.
+        Returns: None or the error message
+    """
+    with open(guild_data_file, "r") as fi:
+        rating_data = json.load(fi)
+    # Old snapshots list games whose infos expired long ago
+    game_infos = game_cache.GameInfoCache(cache, ttl=float("inf"),
+                                          legacy=None, read_only=True)
+    try:
+        lists_dict = build_lists(rating_data, b, n, s, game_infos,
+                                 bgg_api.BGGClient(offline=True),
+                                 specs=specs, prior_weight=prior_weight)
+    except (bgg_api.BGGOfflineError, list_specs.SpecError) as e:
+        return "%s: %s" % (guild_data_file, e)
+    finally:
+        game_infos.close()
+    with open(lists_file, "w") as fo:
+        json.dump(lists_dict, fo)
+    return None
+
+
+def render_lists(lists_file, outputs):
+    """Batch job: print_lists of lists_file for every (style, lang,
+        filename) of outputs
+    """
+    with open(lists_file, "r") as fi:
+        data = json.load(fi)
+    for style, lang, filename in outputs:
+        print_lists.render_file(data, style, lang, filename)
+
+
+def render_diff(old_file, new_file, outputs, categories, dropped=False):
+    """Batch job: diff_toplists of two lists files for every (style,
+        lang, filename) of outputs, categories None for all
+    """
+    with open(old_file, "r") as fi:
+        old_lists = json.load(fi)
+    with open(new_file, "r") as fi:
+        new_lists = json.load(fi)
+    if categories is None:
+        categories = diff_toplists.all_categories(new_lists)
+    for style, lang, filename in outputs:
+        diff_toplists.render_file(old_lists, new_lists, style, lang,
+                                  filename, categories, dropped)
+
+
+def backfill(directory, out_dir, styles=("html",), langs=("en",),
+             categories=("top",), dropped=False,
+             cache=game_cache.DEFAULT_FILENAME, b=10, n=50, s=50,
+             specs=list_specs.DEFAULT_SPECS, ranking="mean",
+             prior_weight=DEFAULT_PRIOR_WEIGHT, keep_lists=False, jobs=1):
+    """Regenerate, render and diff the snapshots in directory, writing
+        to out_dir in jobs processes. keep_lists renders existing lists
+        files instead of regenerating them, categories None diffs all.
+        Returns: The error messages of snapshots not regenerated
+        Raises: ValueError if out_dir is directory
+    """
+    if os.path.realpath(out_dir) == os.path.realpath(directory):
+        raise ValueError("%s would overwrite the published snapshots, "
+                         "choose another output directory" % out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    snapshots = find_snapshots(directory)
+    specs = list_specs.rank_by(specs, ranking)
+
+    regenerate_jobs = list()
+    lists_files = dict()
+    for guild, dated in snapshots.items():
+        for date_str, guild_data_file, lists_file in dated:
+            if guild_data_file is not None and not (
+                    keep_lists and lists_file is not None):
+                lists_file = os.path.join(
+                    out_dir, "lists_" + label(guild, date_str) + ".json")
+                regenerate_jobs.append((guild_data_file, lists_file, cache,
+                                        b, n, s, specs, prior_weight))
+            lists_files[guild, date_str] = lists_file
+    print("Regenerating %d lists in %d processes"
+          % (len(regenerate_jobs), jobs))
+    errors = list()
+    for args, error in zip(regenerate_jobs,
+                           run_batch(regenerate, regenerate_jobs, jobs)):
+        if error is not None:
+            errors.append(error)
+            lists_files = {k: v for k, v in lists_files.items()
+                           if v != args[1]}
+
+    # several outputs are told apart by _lang_style
+    batch = len(styles) * len(langs) > 1
+
+    def outputs(prefix, name):
+        return [(style, lang,
+                 os.path.join(out_dir, output_filename(
+                     prefix, name, style, lang if batch else None)))
+                for lang in langs for style in styles]
+
+    render_jobs = list()
+    diff_jobs = list()
+    for guild, dated in snapshots.items():
+        previous = None
+        for date_str, _, _ in dated:
+            lists_file = lists_files.get((guild, date_str))
+            if lists_file is None:
+                continue
+            render_jobs.append((lists_file,
+                                outputs("output", label(guild, date_str))))
+            if previous is not None:
+                diff_jobs.append((
+                    lists_files[guild, previous], lists_file,
+                    outputs("topdiff", label(guild, previous, date_str)),
+                    categories, dropped))
+            previous = date_str
+    print("Rendering %d lists and %d diffs in %d processes"
+          % (len(render_jobs), len(diff_jobs), jobs))
+    run_batch(render_lists, render_jobs, jobs)
+    run_batch(render_diff, diff_jobs, jobs)
+    return errors
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Regenerate, render and diff all dated snapshots of a "
+                    "directory")
+    parser.add_argument(
+        "directory",
+        help="directory of guild_data_YYYYMMDD.json and lists_YYYYMMDD.json "
+             "files")
+    parser.add_argument(
+        "-o", "--out-dir", required=True,
+        help="write the lists and reports to OUT_DIR, which must not be "
+             "DIRECTORY")
+    parser.add_argument(
+        "-b", type=int, default=10,
+        help="output the bottom, most/least variable & most rated B games")
+    parser.add_argument(
+        "-n", type=int, default=50,
+        help="output the top N games, default=50")
+    parser.add_argument(
+        "-s", type=int, default=50,
+        help="output the top S sleepers, default=50")
+    parser.add_argument(
+        "--cache", default=game_cache.DEFAULT_FILENAME,
+        help="game info cache, only read, default="
+             + game_cache.DEFAULT_FILENAME)
+    parser.add_argument(
+        "--categories",
+        default="top",
+        help="categories to diff separated by commas or all - default: top")
+    parser.add_argument(
+        "--dropped",
+        action="store_true",
+        help="list the games which dropped out of a list")
+    parser.add_argument(
+        "--keep-lists", action="store_true",
+        help="render existing lists files instead of regenerating them")
+    parser.add_argument(
+        "--lang",
+        default="en",
+        help="language for headlines and tableheaders, several separated "
+             "by commas - default: en")
+    parser.add_argument(
+        "--lists",
+        help="LISTS = JSON file of list specs replacing the default lists, "
+             "see list_specs.py")
+    parser.add_argument(
+        "--prior-weight", type=float, default=DEFAULT_PRIOR_WEIGHT,
+        help="guild mean ratings added to every game for --rank-by bayes, "
+             "default=%d" % DEFAULT_PRIOR_WEIGHT)
+    parser.add_argument(
+        "--rank-by", choices=list_specs.RANKINGS, default="mean",
+        help="order the lists by mean, Bayesian average (bayes), the "
+             "confidence bound of the mean or the mean of the ratings "
+             "z-scored per member (z), default=mean")
+    parser.add_argument(
+        "--style",
+        default="html",
+        help="output format: bbcode|bgg|html, several separated by "
+             "commas - default: html")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="run in JOBS processes, default: one per core")
+    args = parser.parse_args()
+    if not os.path.exists(args.cache) and not args.keep_lists:
+        parser.error("game info cache %s not found" % args.cache)
+    specs = list_specs.DEFAULT_SPECS
+    if args.lists:
+        try:
+            specs = list_specs.load_specs(args.lists)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
+    if os.path.realpath(args.out_dir) == os.path.realpath(args.directory):
+        parser.error("OUT_DIR must not be DIRECTORY, the published lists "
+                     "would be overwritten")
+
+    errors = backfill(
+        args.directory,
+        args.out_dir,
+        styles=[normalize_style(x) for x in split_choices(args.style)],
+        langs=split_choices(args.lang),
+        categories=(None if args.categories == "all"
+                    else split_choices(args.categories)),
+        dropped=args.dropped,
+        cache=args.cache,
+        b=args.b,
+        n=args.n,
+        s=args.s,
+        specs=specs,
+        ranking=args.rank_by,
+        prior_weight=args.prior_weight,
+        keep_lists=args.keep_lists,
+        jobs=args.jobs)
+    for error in errors:
+        print(error)
+    if errors:
+        parser.exit(1, "%d snapshots could not be regenerated\n"
+                    % len(errors))
+    print("Finished")
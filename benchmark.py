@@ -0,0 +1,481 @@
+# Benchmarks for the guild report scripts on synthetic data
+#
+# Nothing is fetched from BGG, the member ratings are generated. The end
+# to end benchmark runs generate_lists.py against fake_bgg.py.
+
+import contextlib
+import datetime
+import functools
+import gettext
+import json
+import os
+import random
+import resource
+from statistics import mean, stdev
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ratings import RatingAccumulator, aggregate_ratings
+
+# BGG allows ratings with decimals, some members use them
+SYNTHETIC_RATINGS = (1, 2, 3, 4, 5, 6, 6.5, 7, 7.3, 7.5, 7.75, 8, 8.2, 8.5,
+                     9, 10)
+
+
+def synthetic_members(members, games, per_member=150, seed=1):
+    """Generate the members one at a time, popular games (low ids) are
+        rated far more often than others.
+        Yields: (member, dict gameid -> rating)
+    """
+    rnd = random.Random(seed)
+    for idx in range(members):
+        size = min(games, max(1, int(rnd.expovariate(1 / per_member))))
+        rated = set()
+        while len(rated) < size:
+            rated.add(int(rnd.paretovariate(0.6)) % games + 1)
+        yield "member%d" % idx, {
+            game: rnd.choice(SYNTHETIC_RATINGS) for game in rated}
+
+
+def synthetic_member_ratings(members, games, per_member=150, seed=1):
+    """Returns a dict member -> dict gameid -> rating"""
+    return dict(synthetic_members(members, games, per_member, seed))
+
+
+def synthetic_game_infos(games, expansion_rate=0.3, seed=1):
+    """Returns a dict gameid (str) -> {"name", "expansion", "year"}"""
+    rnd = random.Random(seed)
+    return {str(game): {"name": "Game %d" % game,
+                        "expansion": rnd.random() < expansion_rate,
+                        "year": 1970 + game % 55}
+            for game in range(1, games + 1)}
+
+
+def synthetic_guild(members, games, per_member=150, seed=1):
+    """Returns: (member ratings, game infos) of a synthetic guild"""
+    return (synthetic_member_ratings(members, games, per_member, seed),
+            synthetic_game_infos(games, seed=seed))
+
+
+def perturbed_ratings(member_ratings, fraction=0.1, seed=1):
+    """A later state of member_ratings: fraction of the members changed
+        some ratings and rated new games
+    """
+    rnd = random.Random(seed)
+    games = max(max(x, default=0) for x in member_ratings.values())
+    perturbed = dict()
+    for member, ratings in member_ratings.items():
+        ratings = dict(ratings)
+        if rnd.random() < fraction:
+            for game in rnd.sample(sorted(ratings), len(ratings) // 10):
+                ratings[game] = rnd.randint(1, 10)
+            for _ in range(5):
+                ratings[int(rnd.paretovariate(0.6)) % games + 1] = \
+                    rnd.randint(5, 10)
+        perturbed[member] = ratings
+    return perturbed
+
+
+def aggregate_ratings_statistics(member_ratings):
+    """The former aggregation: per game lists and the statistics module"""
+    guild_ratings = dict()
+    for ratings in member_ratings.values():
+        for game, rating in ratings.items():
+            guild_ratings.setdefault(game, []).append(rating)
+    all_games = list()
+    for game_id, ratings in guild_ratings.items():
+        num_ratings = len(ratings)
+        avg_rating = round(mean(ratings), 3)
+        if num_ratings > 1:
+            sd_ratings = round(stdev(ratings), 3)
+        else:
+            sd_ratings = 0
+        all_games.append((game_id, num_ratings, avg_rating, sd_ratings))
+    return all_games
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_rss():
+    """Peak resident set size of the process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def measure(args, label, func, *func_args, items=None, unit="items",
+            repeat=1):
+    """Run func repeat times and print the time per run and the
+        throughput of items, with the peak of memory allocated by
+        Python if args.trace_memory is set.
+        Returns: The result of the last run
+    """
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*func_args)
+    elapsed = (time.perf_counter() - start) / repeat
+    line = "%-28s %10.4f s" % (label + ":", elapsed)
+    if items is not None:
+        line += "  %12.1f %s/s" % (items / elapsed, unit)
+    if args.trace_memory:
+        line += "  %8.1f MB traced peak" % (
+            tracemalloc.get_traced_memory()[1] / 2 ** 20)
+        tracemalloc.stop()
+    print(line)
+    return result
+
+
+def quiet(func):
+    """func with the progress output of the scripts silenced"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                return func(*args, **kwargs)
+    return wrapper
+
+
+def bench_aggregation(args):
+    member_ratings = synthetic_member_ratings(args.members, args.games)
+    total = sum(len(x) for x in member_ratings.values())
+    new, new_time = timed(aggregate_ratings, member_ratings)
+    print("%d members, %d games, %d ratings"
+          % (args.members, len(new), total))
+    print("numpy:      %8.3f s" % new_time)
+    if args.skip_reference:
+        return
+    old, old_time = timed(aggregate_ratings_statistics, member_ratings)
+    print("statistics: %8.3f s" % old_time)
+    print("speedup:    %8.1fx" % (old_time / new_time))
+    if old != new:
+        print("WARNING: results differ")
+
+
+def bench_streaming(args):
+    """Aggregation of members generated one at a time: all kept in
+        memory first or folded into a RatingAccumulator right away
+    """
+    def batch():
+        return aggregate_ratings(dict(
+            synthetic_members(args.members, args.games)))
+
+    def streaming():
+        accumulator = RatingAccumulator()
+        for rank, (_, ratings) in enumerate(
+                synthetic_members(args.members, args.games)):
+            accumulator.add(ratings, rank)
+        return accumulator.aggregate()
+
+    print("%d members, %d games" % (args.members, args.games))
+    old = measure(args, "batch", batch, items=args.members,
+                  unit="members", repeat=args.repeat)
+    new = measure(args, "streaming", streaming, items=args.members,
+                  unit="members", repeat=args.repeat)
+    differ = sum(x != y for x, y in zip(old, new))
+    if len(old) != len(new) or differ:
+        print("%d games differ in the last digit (no exact recomputation)"
+              % differ)
+
+
+def guild_lists(member_ratings, game_infos, args):
+    """Rating data and lists of a synthetic guild, game infos known"""
+    from generate_lists import build_lists, build_rating_data
+
+    rating_data = quiet(build_rating_data)(list(member_ratings),
+                                           member_ratings)
+    return rating_data, quiet(build_lists)(rating_data, args.b, args.n,
+                                           args.s, dict(game_infos))
+
+
+def bench_e2e(args):
+    from fake_bgg import FakeBGG
+    import generate_lists
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    fake = FakeBGG({args.guild: list(member_ratings)}, member_ratings,
+                   game_infos, latency=args.latency,
+                   queued_rate=args.queued_rate, error_rate=args.error_rate)
+    url = fake.start()
+    print("%d members, %d games at %s, %d workers"
+          % (args.members, args.games, url, args.workers))
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            run = functools.partial(
+                generate_lists.main, args.b, args.n, args.s, str(args.guild),
+                workers=args.workers, rate=args.rate,
+                metrics_out="metrics.json", api=url)
+            measure(args, "generate_lists.main", quiet(run),
+                    items=args.members, unit="members")
+            with open("metrics.json") as f:
+                report = json.load(f)
+    finally:
+        os.chdir(cwd)
+        fake.stop()
+    for phase, seconds in sorted(report["phases"].items()):
+        print("  %-26s %10.4f s" % (phase + ":", seconds))
+    for (endpoint, status), count in sorted(fake.requests.items()):
+        print("  %-26s %10d" % ("%s %d:" % (endpoint, status), count))
+
+
+def bench_lists(args):
+    from generate_lists import build_lists, build_rating_data
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    print("%d members, %d games" % (args.members, args.games))
+    rating_data = measure(
+        args, "build_rating_data", quiet(build_rating_data),
+        list(member_ratings), member_ratings,
+        items=sum(map(len, member_ratings.values())), unit="ratings")
+    measure(args, "build_lists", quiet(build_lists), rating_data,
+            args.b, args.n, args.s, dict(game_infos),
+            items=len(rating_data["sorted_games"]), unit="games",
+            repeat=args.repeat)
+
+
+def bench_render(args):
+    from print_lists import render
+    from reporting import STYLES
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    _, lists = guild_lists(member_ratings, game_infos, args)
+    rows = sum(len(x["games"]) for x in lists["lists"])
+    for style in STYLES:
+        measure(args, "render " + style, render, lists, style,
+                items=rows, unit="rows", repeat=args.repeat)
+
+
+def bench_diff(args):
+    from diff_toplists import (CATEGORIES, diff_lists, rank_trajectories,
+                               render_diff, render_trajectories)
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    snapshots = list()
+    for seed in range(args.snapshots):
+        snapshots.append(guild_lists(member_ratings, game_infos, args)[1])
+        member_ratings = perturbed_ratings(member_ratings, seed=seed)
+    rows = sum(len(x["games"]) for x in snapshots[-1]["lists"])
+    measure(args, "diff_lists", diff_lists, snapshots[-2], snapshots[-1],
+            items=rows, unit="rows", repeat=args.repeat)
+    measure(args, "render_diff", render_diff, snapshots[-2], snapshots[-1],
+            "html", None, CATEGORIES, True,
+            items=rows, unit="rows", repeat=args.repeat)
+    measure(args, "rank_trajectories", rank_trajectories, snapshots,
+            items=len(snapshots), unit="snapshots", repeat=args.repeat)
+    labels = [str(x) for x in range(len(snapshots))]
+    measure(args, "render_trajectories", render_trajectories, snapshots,
+            labels, "html", None, CATEGORIES,
+            items=len(snapshots), unit="snapshots", repeat=args.repeat)
+
+
+def bench_compare(args):
+    import compare_users
+    from similarity import RatingMatrix
+    from snapshot import write_snapshot
+
+    member_ratings = synthetic_member_ratings(args.members, args.games)
+    members = list(member_ratings)
+    matrix = measure(args, "RatingMatrix.from_dict", RatingMatrix.from_dict,
+                     member_ratings, items=len(members), unit="members")
+    measure(args, "compare", matrix.compare, members[0],
+            items=len(members), unit="members", repeat=args.repeat)
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            write_snapshot("member_data.snap", member_ratings)
+            measure(args, "compare_users.main", quiet(compare_users.main),
+                    members[0], "member_data.snap",
+                    items=len(members), unit="members")
+            if args.all_pairs:
+                measure(args, "compare_users --all-pairs",
+                        quiet(compare_users.main), members[0],
+                        "member_data.snap", "score", "all_pairs.npz",
+                        items=len(members) ** 2, unit="pairs")
+    finally:
+        os.chdir(cwd)
+
+
+def bench_recommend(args):
+    import recommend
+    from snapshot import write_snapshot
+
+    member_ratings = synthetic_member_ratings(args.members, args.games)
+    members = list(member_ratings)
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            write_snapshot("member_data.snap", member_ratings)
+            for jobs in sorted({1, args.jobs}):
+                measure(args, "build_index -j %d" % jobs,
+                        recommend.build_index, "member_data.snap",
+                        "index.npz", recommend.DEFAULT_NEIGHBOURS,
+                        "pearson", recommend.DEFAULT_MIN_COMMON,
+                        recommend.DEFAULT_MIN_RATERS, jobs,
+                        items=len(members), unit="members")
+            index = recommend.RecommendationIndex("index.npz")
+            measure(args, "recommend", index.recommend, members[0],
+                    items=1, unit="queries", repeat=args.repeat * 100)
+    finally:
+        os.chdir(cwd)
+
+
+def bench_backfill(args):
+    import backfill
+    import game_cache
+    from generate_lists import build_rating_data
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    # rendering needs the compiled catalogs
+    locales = os.path.abspath("locales")
+    langs = ["en"] if gettext.find("print_lists", locales, ["en"]) else []
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            os.symlink(locales, "locales")
+            os.mkdir("snapshots")
+            cache = game_cache.GameInfoCache(legacy=None)
+            cache.update(game_infos)
+            cache.close()
+            first = datetime.date(2025, 1, 5)
+            for week in range(args.snapshots):
+                rating_data = quiet(build_rating_data)(list(member_ratings),
+                                                       member_ratings)
+                date = first + datetime.timedelta(weeks=week)
+                filename = "snapshots/guild_data_%s.json" % (
+                    date.strftime("%Y%m%d"))
+                with open(filename, "w") as fo:
+                    json.dump(rating_data, fo)
+                member_ratings = perturbed_ratings(member_ratings, seed=week)
+            print("%d snapshots, %s" % (
+                args.snapshots, "rendered" if langs else
+                "not rendered without compiled catalogs"))
+            for jobs in sorted({1, args.jobs}):
+                run = functools.partial(backfill.backfill, "snapshots",
+                                        "out", langs=langs, categories=None,
+                                        jobs=jobs)
+                measure(args, "backfill -j %d" % jobs, quiet(run),
+                        items=args.snapshots, unit="snapshots")
+    finally:
+        os.chdir(cwd)
+
+
+def bench_all(args):
+    for name, func in BENCHMARKS:
+        print("==", name, "==")
+        func(args)
+
+
+BENCHMARKS = (("aggregation", bench_aggregation),
+              ("streaming", bench_streaming), ("lists", bench_lists),
+              ("render", bench_render), ("diff", bench_diff),
+              ("compare", bench_compare), ("recommend", bench_recommend),
+              ("backfill", bench_backfill), ("e2e", bench_e2e))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the guild report scripts on synthetic data")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--members", type=int, default=1000,
+        help="synthetic guild members (100 to 10000), default=1000")
+    common.add_argument("--games", type=int, default=20000)
+    common.add_argument(
+        "--repeat", type=int, default=10,
+        help="runs of the fast benchmarks to average, default=10")
+    common.add_argument(
+        "--trace-memory", action="store_true",
+        help="report the peak of memory allocated by Python per step, "
+             "slows down the steps")
+    common.add_argument("-b", type=int, default=10)
+    common.add_argument("-n", type=int, default=50)
+    common.add_argument("-s", type=int, default=50)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    aggregation = subparsers.add_parser(
+        "aggregation", parents=[common],
+        help="per game count, mean and stdev")
+    aggregation.add_argument(
+        "--skip-reference", action="store_true",
+        help="do not run the former statistics based aggregation")
+    aggregation.set_defaults(func=bench_aggregation)
+    subparsers.add_parser(
+        "streaming", parents=[common],
+        help="batch vs streaming aggregation, use --trace-memory"
+    ).set_defaults(func=bench_streaming)
+    subparsers.add_parser(
+        "lists", parents=[common],
+        help="rating data and list selection, no fetches"
+    ).set_defaults(func=bench_lists)
+    subparsers.add_parser(
+        "render", parents=[common],
+        help="print_lists in every style"
+    ).set_defaults(func=bench_render)
+    diff = subparsers.add_parser(
+        "diff", parents=[common],
+        help="diff_toplists of two runs and a series of runs")
+    diff.add_argument(
+        "--snapshots", type=int, default=12,
+        help="runs in the series, default=12")
+    diff.set_defaults(func=bench_diff)
+    compare = subparsers.add_parser(
+        "compare", parents=[common],
+        help="compare_users on a rating snapshot")
+    compare.add_argument(
+        "--all-pairs", action="store_true",
+        help="also compute the similarity matrices of all members")
+    compare.set_defaults(func=bench_compare)
+    recommend_parser = subparsers.add_parser(
+        "recommend", parents=[common],
+        help="build a recommendation index and query it")
+    recommend_parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="also build in JOBS processes, default: one per core")
+    recommend_parser.set_defaults(func=bench_recommend)
+    backfill_parser = subparsers.add_parser(
+        "backfill", parents=[common],
+        help="backfill.py over a series of weekly snapshots")
+    backfill_parser.add_argument(
+        "--snapshots", type=int, default=12,
+        help="weekly snapshots, default=12")
+    backfill_parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="also run in JOBS processes, default: one per core")
+    backfill_parser.set_defaults(func=bench_backfill)
+    e2e = subparsers.add_parser(
+        "e2e", parents=[common],
+        help="generate_lists.main against a fake BGG server")
+    e2e.add_argument("--guild", type=int, default=1)
+    e2e.add_argument("-w", "--workers", type=int, default=4)
+    e2e.add_argument("--rate", type=float)
+    e2e.add_argument(
+        "--latency", type=float, default=0.01,
+        help="seconds added to every response, default=0.01")
+    e2e.add_argument(
+        "--queued-rate", type=float, default=0.05,
+        help="fraction of requests answered with 202, default=0.05")
+    e2e.add_argument(
+        "--error-rate", type=float, default=0.01,
+        help="fraction of requests answered with 500, default=0.01")
+    e2e.set_defaults(func=bench_e2e)
+    all_benchmarks = subparsers.add_parser(
+        "all", parents=[common],
+        help="all of the above")
+    all_benchmarks.set_defaults(
+        func=bench_all, skip_reference=True, snapshots=12, all_pairs=False,
+        jobs=os.cpu_count(), guild=1, workers=4, rate=None, latency=0.01,
+        queued_rate=0.05, error_rate=0.01)
+    args = parser.parse_args()
+    args.func(args)
+    print("peak RSS: %.1f MB" % peak_rss())
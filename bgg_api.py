@@ -0,0 +1,259 @@
+# Lightweight client for the BGG XML API 2
+#
+# Only the fields the scripts use are extracted, parsing the responses
+# incrementally while they are received. Every thread keeps its own
+# keep-alive connection, so one client can serve all fetch workers. The
+# HTTP and XML modules are imported on the first request, runs working
+# from cached data only never pay for them.
+
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+import metrics
+
+DEFAULT_ENDPOINT = "https://boardgamegeek.com/xmlapi2"
+GAME_TYPES = ("boardgame", "boardgameexpansion", "boardgameaccessory")
+
+
+class BGGApiError(Exception):
+    """A request to BGG failed"""
+
+
+class BGGNotFoundError(BGGApiError):
+    """Unknown user, guild or game"""
+
+
+class BGGQueuedError(BGGApiError):
+    """BGG kept answering 202, the request is still queued"""
+
+
+class BGGRateLimitError(BGGApiError):
+    """BGG answered 429, retry_after is the requested delay or None"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BGGServerError(BGGApiError):
+    """BGG answered with a 5xx status"""
+
+
+class BGGOfflineError(BGGApiError):
+    """A request was needed by a client created offline"""
+
+
+class CountingReader:
+    """File object for iterparse counting the bytes read"""
+
+    def __init__(self, response):
+        self.response = response
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.size += len(data)
+        return data
+
+
+class BGGClient:
+    """Fetches guild members, collection ratings and game infos.
+        202 (queued), 429 and 5xx answers are retried up to retries times,
+        waiting retry_delay seconds, 1.5 times longer on every retry.
+        An offline client raises BGGOfflineError instead of requesting.
+    """
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, timeout=15, retries=3,
+                 retry_delay=5, offline=False):
+        url = urlsplit(endpoint)
+        self.endpoint = endpoint
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.offline = offline
+        self.local = threading.local()
+
+    def connection(self):
+        """The keep-alive connection of the calling thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            import http.client
+            if self.scheme == "https":
+                conn = http.client.HTTPSConnection(
+                    self.host, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(
+                    self.host, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        """Close the connection of the calling thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def send(self, url):
+        """GET url on the thread's connection, reconnecting once if BGG
+            closed it in the meantime.
+        """
+        import http.client
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request("GET", url, headers={"Accept": "text/xml"})
+                return conn.getresponse()
+            except (http.client.HTTPException, ConnectionError) as e:
+                self.close()
+                if attempt == 1:
+                    raise BGGApiError("Request failed: %s" % e) from e
+            except OSError as e:
+                self.close()
+                raise BGGApiError("Request failed: %s" % e) from e
+
+    def get(self, endpoint, params, parse):
+        """Request endpoint and parse the streamed XML response.
+            Returns: The result of parse(events) for iterparse events
+        """
+        url = "%s/%s?%s" % (self.path, endpoint, urlencode(params))
+        if self.offline:
+            raise BGGOfflineError("Offline, not requesting " + url)
+        import xml.etree.ElementTree as ET
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            response = self.send(url)
+            metrics.observe("http", time.perf_counter() - start)
+            metrics.count("http_requests")
+            metrics.count("http_status_%d" % response.status)
+            if response.status == 200:
+                reader = CountingReader(response)
+                try:
+                    return parse(ET.iterparse(reader, events=("end",)))
+                except ET.ParseError as e:
+                    self.close()
+                    raise BGGApiError("Invalid XML: %s" % e) from e
+                finally:
+                    response.read()
+                    metrics.count("bytes_received", reader.size)
+            body = response.read()
+            metrics.count("bytes_received", len(body))
+            if response.status == 202:
+                error = BGGQueuedError("Request queued: " + url)
+            elif response.status == 429:
+                retry_after = response.getheader("Retry-After")
+                error = BGGRateLimitError(
+                    "Too many requests: " + url,
+                    float(retry_after) if retry_after else None)
+                if error.retry_after:
+                    delay = max(delay, error.retry_after)
+            elif response.status >= 500:
+                error = BGGServerError(
+                    "HTTP %d: %s" % (response.status, url))
+            else:
+                raise BGGApiError("HTTP %d: %s" % (response.status, url))
+            if attempt == self.retries:
+                raise error
+            time.sleep(delay)
+            delay *= 1.5
+
+    def guild_page(self, guild_id, page):
+        """Returns: (member count, names on page) of guild_id"""
+        return self.get("guild", {"id": guild_id, "members": 1, "page": page},
+                        parse_guild_members)
+
+    def guild_members(self, guild_id, call=None):
+        """call(func, *args) wraps the request of every page if given,
+            e.g. to retry pages separately.
+            Returns: The names of all members of guild_id
+        """
+        if call is None:
+            def call(func, *args):
+                return func(*args)
+        members = list()
+        page = 1
+        while True:
+            count, names = call(self.guild_page, guild_id, page)
+            members.extend(names)
+            if not names or len(members) >= count:
+                return members
+            page += 1
+
+    def collection(self, username, modified_since=None):
+        """Board games in the collection of username, modified_since is
+            a string like "24-01-31 12:00:00".
+            Returns: A dict gameid -> rating, None for unrated games
+        """
+        params = {"username": username, "subtype": "boardgame", "stats": 1}
+        if modified_since is not None:
+            params["modifiedsince"] = modified_since
+        return self.get("collection", params, parse_collection)
+
+    def games(self, game_ids):
+        """Returns: A dict gameid (str) -> {"name": name,
+            "expansion": bool, "year": year or None} of the game_ids
+            known to BGG
+        """
+        return self.get("thing", {"id": ",".join(map(str, game_ids))},
+                        parse_things)
+
+
+def parse_guild_members(events):
+    """Returns: (member count, names on the page) of a guild response"""
+    count = 0
+    names = list()
+    for _, elem in events:
+        if elem.tag == "member":
+            names.append(elem.get("name"))
+            elem.clear()
+        elif elem.tag == "members":
+            count = int(elem.get("count", 0))
+        elif elem.tag == "error":
+            raise BGGNotFoundError((elem.text or "").strip())
+        elif elem.tag == "guild" and elem.get("name") is None:
+            raise BGGNotFoundError("Guild not found")
+    return count, names
+
+
+def parse_collection(events):
+    """Returns: A dict gameid -> rating or None of a collection"""
+    ratings = dict()
+    for _, elem in events:
+        if elem.tag == "item":
+            if elem.get("subtype") == "boardgame":
+                rating = elem.find("stats/rating")
+                value = None if rating is None else rating.get("value")
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = None
+                ratings[int(elem.get("objectid"))] = value
+            elem.clear()
+        elif elem.tag == "message":
+            raise BGGNotFoundError((elem.text or "").strip())
+    return ratings
+
+
+def parse_things(events):
+    """Returns: A dict gameid (str) -> info of a thing response"""
+    game_infos = dict()
+    for _, elem in events:
+        if elem.tag != "item" or elem.get("type") not in GAME_TYPES:
+            continue
+        name = elem.find("name[@type='primary']")
+        year = elem.find("yearpublished")
+        try:
+            year = int(year.get("value"))
+        except (AttributeError, TypeError, ValueError):
+            year = None
+        game_infos[elem.get("id")] = {
+            "name": None if name is None else name.get("value"),
+            "expansion": elem.get("type") == "boardgameexpansion",
+            "year": year}
+        elem.clear()
+    return game_infos
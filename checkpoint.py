@@ -0,0 +1,103 @@
+# Append-only checkpoint of the member ratings fetched during a run
+#
+# Every finished member is written as one JSON line, so an interrupted
+# run can be resumed and only has to fetch the missing members. The time
+# of each fetch is kept, so the next run can ask BGG for changes only.
+
+import datetime
+import json
+import os
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def same_file(filename, other):
+    """Whether both names refer to the same file, existing or not"""
+    if os.path.exists(filename) and os.path.exists(other):
+        return os.path.samefile(filename, other)
+    return os.path.realpath(filename) == os.path.realpath(other)
+
+
+class RatingCheckpoint:
+    """JSON lines file: {"member": name, "fetched": UTC time of the fetch,
+        "ratings": {gameid: rating}}
+    """
+
+    def __init__(self, filename, sync_every=25):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.pending = 0
+        self.file = None
+        self.fetched = dict()
+        self.ratings = None
+
+    def entries(self):
+        """Read the stored members one at a time.
+            Yields: (member, dict gameid -> rating, fetch time or None)
+        """
+        try:
+            fi = open(self.filename, "r")
+        except FileNotFoundError:
+            return
+        with fi:
+            for line in fi:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete last line of an interrupted run
+                    break
+                fetched = entry.get("fetched")
+                if fetched is not None:
+                    fetched = datetime.datetime.strptime(fetched, TIME_FORMAT)
+                yield entry["member"], {
+                    int(game): rating
+                    for game, rating in entry["ratings"].items()}, fetched
+
+    def load(self):
+        """Returns a dict member -> dict gameid -> rating of stored members.
+            It and the fetch times are available in ratings and fetched
+            afterwards.
+        """
+        member_ratings = dict()
+        for member, ratings, fetched in self.entries():
+            member_ratings[member] = ratings
+            if fetched is not None:
+                self.fetched[member] = fetched
+        self.ratings = member_ratings
+        return member_ratings
+
+    def open(self, resume=False):
+        """Open for appending, a new run discards an existing checkpoint"""
+        if not resume:
+            self.file = open(self.filename, "w")
+            return
+        self.file = open(self.filename, "a+")
+        # drop an incomplete last line so appended entries stay parseable
+        self.file.seek(0)
+        content = self.file.read()
+        if content and not content.endswith("\n"):
+            self.file.truncate(content.rfind("\n") + 1)
+        self.file.seek(0, os.SEEK_END)
+
+    def add(self, member, ratings, fetched=None):
+        """Append a member's ratings, synced to disk in batches"""
+        if fetched is None:
+            fetched = datetime.datetime.utcnow()
+        self.file.write(json.dumps({"member": member,
+                                    "fetched": fetched.strftime(TIME_FORMAT),
+                                    "ratings": ratings}))
+        self.file.write("\n")
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -1,40 +1,48 @@
+import math
+
 import yaml
-from boardgamegeek import BGGClient
 
+from similarity import ASCENDING, METRICS, load_rating_matrix
 
-def main(user, member_data_file):
-    bgg = BGGClient()
 
-    with open(member_data_file, "r") as data_file:
-        member_data = yaml.load(data_file)
+def main(user, member_data_file, metric="score", all_pairs=None):
+    rating_matrix = load_rating_matrix(member_data_file)
+    if all_pairs is not None:
+        rating_matrix.save_all_pairs(all_pairs)
+        print("Wrote similarity matrices for",
+              len(rating_matrix.members), "members to", all_pairs)
+        return
 
-    user_data = member_data[user]
-    del member_data[user]
-    user_collection_size = len(user_data)
+    i = rating_matrix.member_index[user]
+    user_collection_size = rating_matrix.indptr[i + 1] - \
+        rating_matrix.indptr[i]
+    results = rating_matrix.compare(user)
 
     member_scores = list()
-    for user, ratings in member_data.items():
-        score = 0
-        games_in_common = 0
-        for game, rating in user_data.items():
-            if game in ratings:
-                diff = (rating - ratings[game])**2
-                score += diff
-                games_in_common += 1
-        member_scores.append(
-            {"user": user, "score": score, "common": games_in_common})
+    for idx, member in enumerate(rating_matrix.members):
+        if idx == i:
+            continue
+        member_score = {"user": member,
+                        "score": float(results["score"][idx]),
+                        "common": int(results["common"][idx])}
+        if metric != "score":
+            member_score[metric] = float(results[metric][idx])
+        member_scores.append(member_score)
 
     member_scores = [x for x in member_scores if x[
-        "common"] >= 0.5 * user_collection_size]
-    member_scores.sort(key=lambda x: x["score"])
+        "common"] >= 0.5 * user_collection_size
+        and not math.isnan(x[metric])]
+    if metric in ASCENDING:
+        member_scores.sort(key=lambda x: x[metric])
+    else:
+        member_scores.sort(key=lambda x: x[metric], reverse=True)
 
     filename = user + "_followers.yml"
     with open(filename, "w") as fo:
         yaml.dump(member_scores, fo)
 
-    for i in range(5):
-        member = member_scores[i]
-        print(member["user"], member["score"], member["common"])
+    for member in member_scores[:5]:
+        print(member["user"], member[metric], member["common"])
 
 
 if __name__ == "__main__":
@@ -42,5 +50,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--user")
     parser.add_argument("--member-data")
+    parser.add_argument(
+        "--metric", choices=METRICS, default="score",
+        help="sort similar members by METRIC, default: score")
+    parser.add_argument(
+        "--all-pairs",
+        help="write the similarity matrices of all members to ALL_PAIRS.npz")
     args = parser.parse_args()
-    main(args.user, args.member_data)
+    main(args.user, args.member_data, args.metric, args.all_pairs)
@@ -2,97 +2,20 @@ import argparse
 import datetime
 import gettext
 import json
+import os
+import re
 
+from reporting import (CATEGORY_NAMES, N_, game_name, load_translation,
+                       normalize_style, output_filename, run_batch,
+                       split_choices)
 
-def print_list(old_file, new_file, style):
-
-    with open(old_file, "r") as oldf:
-        old_lists = json.load(oldf)
-        oldf.close()
-        with open(new_file, "r") as newf:
-            new_lists = json.load(newf)
-            newf.close()
-
-            new_top = new_lists["lists"][0]["games"]
-            old_top = old_lists["lists"][0]["games"]
-            old_top_gameids = [x[1] for x in old_top]
-            old_top_means = [x[3] for x in old_top]
-            old_top_ratings = [x[2] for x in old_top]
-
-            hlevel = "h3"
-            headline = _("Top Diff")
-            ths = [
-                _("No."),
-                _("+/-"),
-                _("Game"),
-                _("Ratings"),
-                _("+/-"),
-                _("Mean"),
-                _("+/-"),
-                _("SD")]
-
-            # table header
-            if style == "html":
-                print("<style>\n\
+HLEVEL = "h3"
+
+# Templates keep the whitespace of the reports published so far
+HTML_STYLE = "<style>\n\
                     .text-right {text-align: right; padding: 0 5px;}\n\
-                    </style>", file=of)
-                print("<", hlevel, ">", headline, "</", hlevel, ">",
-                      sep="", file=of)
-                print("<table id=", headline, "><thead><tr>",
-                      sep="", file=of)
-                for i, th in enumerate(ths):
-                    print("<th>", th, "</th>", sep="", file=of)
-                print("</tr></thead><tbody>", sep="", file=of)
-            elif style == "bbcode":
-                print("[", hlevel, "]", headline,
-                      "[/", hlevel, "]", sep="", file=of)
-                print("[table][tr]", sep="", file=of)
-                for i, th in enumerate(ths):
-                    print("[th]", th, "[/th]", sep="", file=of)
-                print("[/tr]", sep="", file=of)
-            else:
-                name_width = max([len(x[0]) for x in new_top])
-                ratings_width = max(len(ths[3]), 4)
-                mean_width = max(len(ths[5]), 5)
-                sd_width = max(len(ths[7]), 5)
-                format_string = "{:3} {:5} {:" + str(name_width) + "}" \
-                    " {:" + str(ratings_width) + "} {:6}" + \
-                    "  {:" + str(mean_width) + ".3f} {:8}" + \
-                    "  {:" + str(sd_width) + ".3f}"
-                format_headers = "{:3} {:5} {:" + str(name_width) + "}" \
-                    " {:" + str(ratings_width) + "} {:6}" + \
-                    "  {:" + str(mean_width) + "} {:8}" + \
-                    "  {:" + str(sd_width) + "}"
-                print("[b]Top[/b]\n[c]", file=of)
-                print("" + format_headers.format(*ths), file=of)
-
-            # table content
-            for index, game_info in enumerate(new_top):
-                try:
-                    old_index = old_top_gameids.index(game_info[1])
-                except ValueError:
-                    old_index = -1
-
-                if old_index > -1:
-                    diff = old_index - index
-                    diff_ratings = game_info[2] - \
-                        old_top_ratings[old_index]
-                    diff_mean = game_info[3] - \
-                        old_top_means[old_index]
-                    diff_string = "{:>+3}".format(diff)
-                    diff_ratings = "{:>+3}".format(diff_ratings)
-                    diff_mean = "{:+.3f}".format(diff_mean)
-                else:
-                    diff_string = _("new")
-                    diff_mean = ""
-                    diff_ratings = ""
-
-                table_row_data = (index + 1, diff_string, game_info[0],
-                                  game_info[2], diff_ratings,
-                                  game_info[3], diff_mean, game_info[4])
-
-                if style == "html":
-                    print("<tr><td class=\"text-right\">{}</td> \
+                    </style>\n"
+HTML_ROW = "<tr><td class=\"text-right\">{}</td> \
                         <td class=\"text-right\">{}</td> \
                         <td>{}</td> \
                         <td class=\"text-right\">{:4}</td> \
@@ -100,10 +23,8 @@ def print_list(old_file, new_file, style):
                         <td class=\"text-right\">{:6.3f}</td> \
                         <td class=\"text-right\">{}</td> \
                         <td class=\"text-right\">{:6.3f}</td> \
-                        </tr>".format(
-                        *table_row_data), file=of)
-                elif style == "bbcode":
-                    print("[tr][td]{}[/td] \
+                        </tr>\n"
+BBCODE_ROW = "[tr][td]{}[/td] \
                         [td]{}[/td] \
                         [td]{}[/td] \
                         [td]{:4}[/td] \
@@ -111,53 +32,340 @@ def print_list(old_file, new_file, style):
                         [td]{:5.3f}[/td] \
                         [td]{}[/td] \
                         [td]{:5.3f}[/td] \
-                        [/tr]".format(
-                        *table_row_data), file=of)
-                else:
-                    detail_string = format_string.format(*table_row_data)
-                    print(detail_string, file=of)
-
-            # table footer
-            if style == "html":
-                print("</tbody></table>", file=of)
-            elif style == "bbcode":
-                print("[/table]", file=of)
+                        [/tr]\n"
+
+
+CATEGORIES = ("top", "bottom", "variance", "similar", "most_rated",
+              "sleepers")
+DIFF_HEADLINES = {
+    "top": N_("Top Diff"), "bottom": N_("Bottom Diff"),
+    "variance": N_("Most Varied Diff"), "similar": N_("Most Similar Diff"),
+    "most_rated": N_("Most Rated Diff"), "sleepers": N_("Sleepers Diff")}
+
+
+### Diff engine ###
+
+
+def rank_index(games):
+    """Returns: A dict gameid -> (rank, game) for a list's games"""
+    return {game[1]: (rank, game) for rank, game in enumerate(games)}
+
+
+def diff_list(old_games, new_games):
+    """Compare two versions of a list.
+        Returns: (rows, dropped), rows as (rank, old rank or None, game,
+        ratings delta, mean delta) per game of new_games, dropped as
+        (old rank, game) for games of old_games no longer listed
+    """
+    old_index = rank_index(old_games)
+    new_ids = set()
+    rows = list()
+    for rank, game in enumerate(new_games):
+        new_ids.add(game[1])
+        old = old_index.get(game[1])
+        if old is None:
+            rows.append((rank, None, game, None, None))
+        else:
+            old_rank, old_game = old
+            rows.append((rank, old_rank, game,
+                         game[2] - old_game[2], game[3] - old_game[3]))
+    dropped = [(rank, game) for rank, game in enumerate(old_games)
+               if game[1] not in new_ids]
+    return rows, dropped
+
+
+def category_names(lists, _):
+    """Returns: A dict category -> translated name of the default
+        categories, else the title of the list in the lists files
+    """
+    names = dict()
+    for entry in lists["lists"]:
+        names[entry["category"]] = entry.get("title", entry["category"])
+    for category, name in CATEGORY_NAMES.items():
+        names[category] = _(name)
+    return names
+
+
+def all_categories(lists):
+    """Returns: The default categories, then those of list specs in a
+        loaded lists file
+    """
+    return list(CATEGORIES) + [x["category"] for x in lists["lists"]
+                               if x["category"] not in CATEGORIES]
+
+
+def categorized(lists):
+    """Returns: A dict category -> games of a loaded lists file"""
+    return {x["category"]: x["games"] for x in lists["lists"]}
+
+
+def diff_lists(old_lists, new_lists, categories=CATEGORIES):
+    """diff_list for every category present in both lists files.
+        Returns: A list of (category, rows, dropped)
+    """
+    old_categories = categorized(old_lists)
+    new_categories = categorized(new_lists)
+    return [(category,) + diff_list(old_categories[category],
+                                    new_categories[category])
+            for category in categories
+            if category in old_categories and category in new_categories]
+
+
+def rank_trajectories(snapshots, category="top"):
+    """Ranks of every game listed in any of the snapshots (loaded lists
+        files, oldest first) in a single pass.
+        Returns: A list of (game, ranks) with the game as listed last and
+        ranks holding the rank per snapshot or None, ordered by the
+        latest ranks
+    """
+    trajectories = dict()
+    for idx, lists in enumerate(snapshots):
+        for rank, game in enumerate(categorized(lists).get(category, [])):
+            if game[1] not in trajectories:
+                trajectories[game[1]] = [game, [None] * len(snapshots)]
+            trajectories[game[1]][0] = game
+            trajectories[game[1]][1][idx] = rank
+
+    def latest(item):
+        ranks = item[1]
+        return [float("inf") if x is None else x for x in reversed(ranks)]
+
+    return [tuple(x) for x in sorted(trajectories.values(), key=latest)]
+
+
+### Rendering ###
+
+
+def render_header(parts, headline, ths, style):
+    if style == "html":
+        parts.extend(["<", HLEVEL, ">", headline, "</", HLEVEL, ">\n",
+                      "<table id=", headline, "><thead><tr>\n"])
+        parts.extend("<th>" + th + "</th>\n" for th in ths)
+        parts.append("</tr></thead><tbody>\n")
+    elif style == "bbcode":
+        parts.extend(["[", HLEVEL, "]", headline, "[/", HLEVEL, "]\n",
+                      "[table][tr]\n"])
+        parts.extend("[th]" + th + "[/th]\n" for th in ths)
+        parts.append("[/tr]\n")
+
+
+def render_footer(parts, style):
+    if style == "html":
+        parts.append("</tbody></table>\n")
+    elif style == "bbcode":
+        parts.append("[/table]\n")
+    else:
+        parts.append("[/c]\n")
+
+
+def render_diff(old_lists, new_lists, style, translation=None,
+                categories=("top",), dropped=False):
+    """Render the lists of categories in new_lists with changes since
+        old_lists, with dropped games listed below if dropped is set.
+        Returns: The report as string
+    """
+    if translation is None:
+        translation = gettext.NullTranslations()
+    _ = translation.gettext
+
+    ths = [
+        _("No."),
+        _("+/-"),
+        _("Game"),
+        _("Ratings"),
+        _("+/-"),
+        _("Mean"),
+        _("+/-"),
+        _("SD")]
+
+    names = category_names(new_lists, _)
+    parts = [HTML_STYLE] if style == "html" else []
+    for category, rows, dropped_games in diff_lists(
+            old_lists, new_lists, categories):
+        if category in DIFF_HEADLINES:
+            headline = _(DIFF_HEADLINES[category])
+        else:
+            headline = names[category] + " " + _("Diff")
+        games = [row[2] for row in rows]
+        if dropped:
+            games.extend(game for _rank, game in dropped_games)
+
+        # table header
+        render_header(parts, headline, ths, style)
+        if style == "html":
+            row_template = HTML_ROW
+        elif style == "bbcode":
+            row_template = BBCODE_ROW
+        else:
+            name_width = max([len(game_name(x)) for x in games]
+                             + [len(ths[2])])
+            ratings_width = max(len(ths[3]), 4)
+            mean_width = max(len(ths[5]), 5)
+            sd_width = max(len(ths[7]), 5)
+            row_template = "{:3} {:5} {:" + str(name_width) + "}" \
+                " {:" + str(ratings_width) + "} {:6}" + \
+                "  {:" + str(mean_width) + ".3f} {:8}" + \
+                "  {:" + str(sd_width) + ".3f}\n"
+            format_headers = "{:3} {:5} {:" + str(name_width) + "}" \
+                " {:" + str(ratings_width) + "} {:6}" + \
+                "  {:" + str(mean_width) + "} {:8}" + \
+                "  {:" + str(sd_width) + "}"
+            title = "Top" if category == "top" else headline
+            parts.extend(["[b]", title, "[/b]\n[c]\n",
+                          format_headers.format(*ths), "\n"])
+
+        # table content
+        for rank, old_rank, game, diff_ratings, diff_mean in rows:
+            if old_rank is not None:
+                diff_string = "{:>+3}".format(old_rank - rank)
+                diff_ratings = "{:>+3}".format(diff_ratings)
+                diff_mean = "{:+.3f}".format(diff_mean)
             else:
-                print("[/c]", file=of)
+                diff_string = _("new")
+                diff_mean = ""
+                diff_ratings = ""
+            parts.append(row_template.format(
+                rank + 1, diff_string, game_name(game), game[2], diff_ratings,
+                game[3], diff_mean, game[4]))
+        if dropped:
+            for _rank, game in dropped_games:
+                parts.append(row_template.format(
+                    "", _("out"), game_name(game), game[2], "",
+                    game[3], "", game[4]))
+
+        # table footer
+        render_footer(parts, style)
+    return "".join(parts)
+
+
+def render_trajectories(snapshots, labels, style, translation=None,
+                        categories=("top",)):
+    """Render the rank history of categories over snapshots (loaded lists
+        files, oldest first) with a column per label.
+        Returns: The report as string
+    """
+    if translation is None:
+        translation = gettext.NullTranslations()
+    _ = translation.gettext
+
+    ths = [_("No."), _("Game")] + list(labels)
+    names = dict()
+    for lists in snapshots:
+        names.update(category_names(lists, _))
+    parts = [HTML_STYLE] if style == "html" else []
+    for category in categories:
+        headline = _("Rank History") + " " + names.get(category, category)
+        rows = [[idx + 1, game_name(game)]
+                + ["-" if x is None else x + 1 for x in ranks]
+                for idx, (game, ranks)
+                in enumerate(rank_trajectories(snapshots, category))]
+
+        render_header(parts, headline, ths, style)
+        if style == "html":
+            cell = "<td class=\"text-right\">{}</td>"
+            row_template = "<tr>" + cell + "<td>{}</td>" \
+                + cell * len(labels) + "</tr>\n"
+        elif style == "bbcode":
+            row_template = "[tr]" + "[td]{}[/td]" * len(ths) + "[/tr]\n"
+        else:
+            name_width = max([len(x[1]) for x in rows] + [len(ths[1])])
+            row_template = "{:>3} {:" + str(name_width) + "}" + "".join(
+                " {:>" + str(max(len(x), 4)) + "}" for x in labels) + "\n"
+            parts.extend(["[b]", headline, "[/b]\n[c]\n",
+                          row_template.format(*ths)])
+        parts.extend(row_template.format(*row) for row in rows)
+        render_footer(parts, style)
+    return "".join(parts)
+
+
+def snapshot_label(filename):
+    """The date of a lists_YYYYMMDD.json file, else its name"""
+    match = re.search(r"(\d{8})\D*$", os.path.basename(filename))
+    return match.group(1) if match else os.path.basename(filename)
+
+
+def render_file(old_lists, new_lists, style, lang, filename,
+                categories=("top",), dropped=False):
+    """Batch job: write the diff in style and lang to filename"""
+    report = render_diff(old_lists, new_lists, style,
+                         load_translation("diff_toplists", lang),
+                         categories, dropped)
+    with open(filename, "w") as of:
+        of.write(report)
+
+
+def render_series_file(snapshots, labels, style, lang, filename,
+                       categories=("top",)):
+    """Batch job: write the rank histories in style and lang to filename"""
+    report = render_trajectories(snapshots, labels, style,
+                                 load_translation("diff_toplists", lang),
+                                 categories)
+    with open(filename, "w") as of:
+        of.write(report)
+
 
 if __name__ == "__main__":
     # parse arguments
     parser = argparse.ArgumentParser(
         description="Print top x with diffs in a pretty format")
     parser.add_argument(
-        "old",
-        help="old top file")
-    parser.add_argument(
-        "new",
-        help="new top file")
+        "files", nargs="+",
+        help="old and new lists file, or several with --series")
     parser.add_argument(
         "--style",
         default="html",
-        help="output format: bbcode|bgg|html - default: html")
+        help="output format: bbcode|bgg|html, several separated by "
+             "commas - default: html")
     parser.add_argument(
         "--lang",
         default="en",
-        help="language for headlines and tableheaders - default: en")
+        help="language for headlines and tableheaders, several separated "
+             "by commas - default: en")
+    parser.add_argument(
+        "--categories",
+        default="top",
+        help="categories to diff separated by commas or all - default: top")
+    parser.add_argument(
+        "--dropped",
+        action="store_true",
+        help="list the games which dropped out of a list")
+    parser.add_argument(
+        "--series",
+        action="store_true",
+        help="print the rank history over all files, oldest first")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="render in JOBS processes, default=1")
     args = parser.parse_args()
+    if len(args.files) < 2 or (len(args.files) > 2 and not args.series):
+        parser.error("expecting old and new file or --series")
 
-    lang = gettext.translation("diff_toplists", localedir="locales",
-                               languages=[args.lang])
-    lang.install()
-    _ = lang.gettext
-
-    if (args.style == "bgg") or (args.style == "bbcode"):
-        style = args.style
-        ext = "txt"
+    snapshots = list()
+    for filename in args.files:
+        with open(filename, "r") as fi:
+            snapshots.append(json.load(fi))
+    styles = [normalize_style(x) for x in split_choices(args.style)]
+    langs = split_choices(args.lang)
+    if args.categories == "all":
+        categories = all_categories(snapshots[-1])
     else:
-        style = "html"
-        ext = "html"
+        categories = split_choices(args.categories)
 
+    # several outputs are told apart by topdiff_YYYYMMDD_lang_style
     date_str = datetime.datetime.now().strftime("%Y%m%d")
-    with open("topdiff_" + date_str + "." + ext, "w") as of:
-        print_list(args.old, args.new, style)
-        of.close()
+    batch = len(styles) * len(langs) > 1
+    if args.series:
+        labels = [snapshot_label(x) for x in args.files]
+        jobs = [(snapshots, labels, style, lang,
+                 output_filename("series", date_str, style,
+                                 lang if batch else None),
+                 categories)
+                for lang in langs for style in styles]
+        run_batch(render_series_file, jobs, args.jobs)
+    else:
+        jobs = [(snapshots[0], snapshots[1], style, lang,
+                 output_filename("topdiff", date_str, style,
+                                 lang if batch else None),
+                 categories, args.dropped)
+                for lang in langs for style in styles]
+        run_batch(render_file, jobs, args.jobs)
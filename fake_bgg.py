@@ -0,0 +1,216 @@
+# Local stand-in for the BGG XML API 2
+#
+# Serves the guild, collection and thing endpoints from synthetic data
+# so the scripts can be benchmarked without sending a single request to
+# BGG. Latency, 202 "queued" responses and errors are simulated, as are
+# collection requests with modifiedsince returning the changed items only.
+
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+PAGE_SIZE = 25
+MODIFIED_SINCE_FORMAT = "%y-%m-%d %H:%M:%S"
+
+
+class FakeBGGHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        endpoint = url.path.rstrip("/").rsplit("/", 1)[-1]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        status, body = fake.respond(endpoint, params)
+        content_type = "text/xml; charset=utf-8"
+        if status != 200:
+            content_type = "text/html; charset=utf-8"
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBGG:
+    """BGG XML API server for synthetic guilds.
+        guilds: dict guild id -> list of members
+        member_ratings: dict member -> dict gameid -> rating
+        game_infos: dict gameid -> {"name", "expansion", "year"}
+        created: UTC time the synthetic collection items were last
+        modified, items changed with change() are stamped with the time
+        of the call
+        latency: seconds added to every response
+        queued_rate, error_rate: fraction of requests answered with 202
+        and error_status, guild member pages never fail
+    """
+
+    def __init__(self, guilds, member_ratings, game_infos, latency=0,
+                 queued_rate=0, error_rate=0, error_status=500, seed=1,
+                 created=datetime.datetime(2020, 1, 1)):
+        self.guilds = {str(k): v for k, v in guilds.items()}
+        self.member_ratings = member_ratings
+        self.created = created
+        self.modified = dict()
+        self.game_infos = {str(k): v for k, v in game_infos.items()}
+        self.latency = latency
+        self.queued_rate = queued_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = dict()
+        self.server = None
+
+    def count(self, endpoint, status):
+        with self.lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def change(self, member, game, rating):
+        """Rate game in the collection of member, None keeps it unrated"""
+        with self.lock:
+            self.member_ratings.setdefault(member, dict())[game] = rating
+            self.modified.setdefault(member, dict())[game] = \
+                datetime.datetime.utcnow()
+
+    def respond(self, endpoint, params):
+        """Returns: (HTTP status, body) for a request of endpoint"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.error_rate and endpoint != "guild":
+            status, body = self.error_status, "<html>Server error</html>"
+        elif draw < self.error_rate + self.queued_rate:
+            status, body = 202, ("<message>Your request for this collection "
+                                 "has been accepted and will be processed."
+                                 "</message>")
+        elif endpoint == "guild":
+            status, body = 200, self.guild_xml(params)
+        elif endpoint == "collection":
+            status, body = 200, self.collection_xml(params)
+        elif endpoint == "thing":
+            status, body = 200, self.thing_xml(params)
+        else:
+            status, body = 404, "<html>Not found</html>"
+        self.count(endpoint, status)
+        return status, body
+
+    def guild_xml(self, params):
+        guild_id = params.get("id", "")
+        members = self.guilds.get(guild_id)
+        if members is None:
+            return ('<guild id=%s><error>Guild not found.</error></guild>'
+                    % quoteattr(guild_id))
+        parts = ['<guild id=%s name=%s created="2010-01-01">'
+                 % (quoteattr(guild_id), quoteattr("Guild " + guild_id))]
+        if params.get("members") == "1":
+            page = int(params.get("page", 1))
+            parts.append('<members count="%d" page="%d">'
+                         % (len(members), page))
+            for member in members[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]:
+                parts.append('<member name=%s date="2010-01-01"/>'
+                             % quoteattr(member))
+            parts.append("</members>")
+        parts.append("</guild>")
+        return "".join(parts)
+
+    def collection_xml(self, params):
+        member = params.get("username", "")
+        ratings = self.member_ratings.get(member)
+        if ratings is None:
+            return ("<errors><error><message>Invalid username specified"
+                    "</message></error></errors>")
+        if "modifiedsince" in params:
+            since = datetime.datetime.strptime(params["modifiedsince"],
+                                               MODIFIED_SINCE_FORMAT)
+            modified = self.modified.get(member, {})
+            ratings = {game: rating for game, rating in ratings.items()
+                       if modified.get(game, self.created) >= since}
+        parts = ['<items totalitems="%d">' % len(ratings)]
+        for game, rating in ratings.items():
+            info = self.game_infos.get(str(game), {})
+            parts.append(
+                '<item objecttype="thing" objectid="%d" subtype="boardgame">'
+                '<name sortindex="1">%s</name>'
+                '<stats minplayers="1" maxplayers="4"><rating value="%s"/>'
+                '</stats><status own="1"/></item>'
+                % (int(game), escape(info.get("name", "Game %s" % game)),
+                   "N/A" if rating is None else rating))
+        parts.append("</items>")
+        return "".join(parts)
+
+    def thing_xml(self, params):
+        parts = ["<items>"]
+        for game in params.get("id", "").split(","):
+            info = self.game_infos.get(game)
+            if info is None:
+                continue
+            parts.append(
+                '<item type=%s id="%d"><name type="primary" value=%s/>'
+                '<yearpublished value="%d"/><statistics page="1"><ratings>'
+                '<usersrated value="0"/></ratings></statistics></item>'
+                % ('"boardgameexpansion"' if info["expansion"]
+                   else '"boardgame"',
+                   int(game), quoteattr(info["name"]), info["year"] or 0))
+        parts.append("</items>")
+        return "".join(parts)
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread, returns the API base url"""
+        self.server = ThreadingHTTPServer((host, port), FakeBGGHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/xmlapi2" % (host, port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from benchmark import synthetic_guild
+
+    parser = argparse.ArgumentParser(
+        description="Serve a synthetic guild through a fake BGG XML API")
+    parser.add_argument("--guild", type=int, default=1)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--games", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds added to every response")
+    parser.add_argument("--queued-rate", type=float, default=0,
+                        help="fraction of requests answered with 202")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of requests answered with 500")
+    parser.add_argument("--port", type=int, default=8044)
+    args = parser.parse_args()
+
+    member_ratings, game_infos = synthetic_guild(args.members, args.games)
+    fake = FakeBGG({args.guild: list(member_ratings)}, member_ratings,
+                   game_infos, latency=args.latency,
+                   queued_rate=args.queued_rate, error_rate=args.error_rate)
+    fake.start(port=args.port)
+    print("Serving guild", args.guild, "at", fake.url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,115 @@
+# Persistent cache of game infos fetched from BGG
+#
+# Replaces the game_infos.json file which was loaded whole, never expired
+# and only written at the end of a run. Every resolved game is committed
+# to the SQLite database right away.
+
+import json
+import os
+import sqlite3
+import time
+from urllib.parse import quote
+
+DEFAULT_FILENAME = "game_infos.sqlite"
+LEGACY_FILENAME = "game_infos.json"
+DEFAULT_TTL = 90 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class GameInfoCache:
+    """Maps gameid (str) -> {"name": name, "expansion": bool, ...}.
+        Entries older than ttl seconds count as missing, the oldest
+        entries are evicted when more than max_entries are stored. A
+        read_only cache opens an existing database which several
+        processes may share, storing infos fails.
+    """
+
+    def __init__(self, filename=DEFAULT_FILENAME, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, legacy=LEGACY_FILENAME,
+                 read_only=False):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = dict()
+        self.hits = set()
+        self.misses = set()
+        if read_only:
+            self.conn = sqlite3.connect(
+                "file:%s?mode=ro" % quote(os.path.abspath(filename)),
+                uri=True)
+            return
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS games ("
+                "id INTEGER PRIMARY KEY, info TEXT NOT NULL, "
+                "fetched REAL NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS games_fetched ON games(fetched)")
+        if legacy and len(self) == 0 and os.path.exists(legacy):
+            with open(legacy, "r") as fi:
+                self.update(json.load(fi))
+            print("Imported", len(self), "game infos from", legacy)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def get(self, gameid, default=None):
+        """Returns the info for gameid or default if missing or expired"""
+        gameid = str(gameid)
+        if gameid in self.memory:
+            return self.memory[gameid]
+        row = self.conn.execute(
+            "SELECT info FROM games WHERE id = ? AND fetched >= ?",
+            (int(gameid), time.time() - self.ttl)).fetchone()
+        if row is None:
+            self.misses.add(gameid)
+            return default
+        if gameid not in self.misses:
+            self.hits.add(gameid)
+        info = json.loads(row[0])
+        self.memory[gameid] = info
+        return info
+
+    def __contains__(self, gameid):
+        return self.get(gameid) is not None
+
+    def __getitem__(self, gameid):
+        info = self.get(gameid)
+        if info is None:
+            raise KeyError(gameid)
+        return info
+
+    def __setitem__(self, gameid, info):
+        self.update({gameid: info})
+
+    def update(self, game_infos):
+        """Store several infos in one transaction"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO games (id, info, fetched) "
+                "VALUES (?, ?, ?)",
+                [(int(gameid), json.dumps(info), now)
+                 for gameid, info in game_infos.items()])
+        for gameid, info in game_infos.items():
+            self.memory[str(gameid)] = info
+        self.evict()
+
+    def evict(self):
+        """Delete the oldest entries exceeding max_entries"""
+        excess = len(self) - self.max_entries
+        if excess <= 0:
+            return
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM games WHERE id IN ("
+                "SELECT id FROM games ORDER BY fetched LIMIT ?)", (excess,))
+        self.memory.clear()
+
+    def report(self):
+        print("Game info cache ", self.filename, ": ", len(self.hits),
+              " hits, ", len(self.misses), " misses", sep="")
+
+    def close(self):
+        self.conn.close()
@@ -4,27 +4,44 @@
 # BGG Guild.
 #
 # TODO: Pydoc strings
-# TODO: Refactor user retries
 # TODO: Implement pastable report
-# TODO: Remove dependency on boardgamegeek module to make better queries
 
 import csv
 import datetime
 import json
 import math
-from queue import Queue
-from statistics import mean, stdev
-import yaml
-
-from boardgamegeek import BGGClient
+from operator import itemgetter
+import threading
+import time
+
+import bgg_api
+from bgg_api import BGGClient
+from checkpoint import RatingCheckpoint, same_file
+import game_cache
+import history
+import list_specs
+import metrics
+import numpy as np
+
+from ratings import (DEFAULT_PRIOR_WEIGHT, RatingAccumulator,
+                     aggregate_ratings, bayesian_means, confidence_bounds,
+                     normalized_means, select_smallest)
+import retry
+from retry import RetryScheduler
+from snapshot import write_snapshot
 
 # guild ids
 HEAVY_CARDBOARD = 2044
 PUNCHING_CARDBOARD = 1805
 UNKNOWNS = 3422
+GUILDS = {"hc": HEAVY_CARDBOARD, "pc": PUNCHING_CARDBOARD, "uk": UNKNOWNS}
+
+# BGG's clock is not ours, ask for changes with some safety margin
+MODIFIED_SINCE_MARGIN = datetime.timedelta(days=1)
 
 # Dictionary Keys
 SORTED_GAMES = "sorted_games"
+NORMALIZED_MEANS = "normalized_means"
 SUMMARY = "summary"
 TOTAL_GAMES = "total_games_rated"
 GUILD_MEMBER_COUNT = "guild_members"
@@ -34,50 +51,93 @@ TIME = "time_at_generation"
 ### Functions that fetch from BGG ###
 
 
-def get_guild_user_list(guild_id, bgg=None):
+def get_guild_user_list(guild_id, bgg=None, scheduler=None):
     """Fetch the member list for a BGG Guild"""
     if bgg is None:
-        bgg = BGGClient()
+        bgg = BGGClient(retries=0)
+    if scheduler is None:
+        scheduler = RetryScheduler()
     print("Fetching guild user list")
-    guild = bgg.guild(guild_id)
-    return list(guild.members)
+    with metrics.timed("guild"):
+        return bgg.guild_members(guild_id, call=scheduler.call)
 
 
 def get_user_ratings(username, bgg=None):
     """Returns a dict: gameid -> rating"""
     if bgg is None:
-        bgg = BGGClient()
-    user_ratings = dict()
-    collection = bgg.collection(username)
-    print(collection)
-    for item in collection:
-        if item.rating:
-            user_ratings[item.id] = item.rating
-    return user_ratings
-
-
-def get_game_info(game_id, bgg=None):
-    """Fetch the BGG info for game having game_id"""
-    print("Fetching info for game", str(game_id))
-    if bgg is None:
-        bgg = BGGClient()
-    game = None
-    while game is None:
-        try:
-            game = bgg.game(game_id=game_id)
-        except Exception:
-            print("Trying to fetch again...")
-            continue
-    return game
+        bgg = BGGClient(retries=0)
+    with metrics.timed("collection"):
+        collection = bgg.collection(username)
+    print("Collection of", username + ":", len(collection), "games")
+    return {game: rating for game, rating in collection.items() if rating}
 
 
-def add_individual_to_group_ratings(master_dict, user_dict):
-    """Combine a user's ratings with the overall ratings"""
-    for game, rating in user_dict.items():
-        if game in master_dict:
-            master_dict[game].append(rating)
+def get_user_rating_changes(username, since, bgg=None):
+    """Returns a dict: gameid -> rating for the collection items modified
+        since the datetime since, rating is None for unrated items.
+        Items removed from the collection are not reported by BGG.
+    """
+    if bgg is None:
+        bgg = BGGClient(retries=0)
+    with metrics.timed("collection_changes"):
+        collection = bgg.collection(
+            username, modified_since=since.strftime("%y-%m-%d %H:%M:%S"))
+    print("Changes of", username + ":", len(collection), "games")
+    return collection
+
+
+def merge_rating_changes(user_ratings, changes):
+    """Apply changes from get_user_rating_changes to a user's ratings"""
+    merged = dict(user_ratings)
+    for game, rating in changes.items():
+        if rating:
+            merged[game] = rating
         else:
-            master_dict[game] = [rating]
+            merged.pop(game, None)
+    return merged
+
+
+def get_game_info(game_id, bgg=None, scheduler=None):
+    """Fetch the BGG info {"name": name, "expansion": bool, "year": year}
+        for game having game_id, None if unavailable
+    """
+    game_infos = get_game_infos([game_id], bgg, scheduler=scheduler)
+    if str(game_id) not in game_infos:
+        print("No info available for game", str(game_id))
+    return game_infos.get(str(game_id))
+
+
+def get_game_infos(game_ids, bgg=None, batch_size=20, scheduler=None):
+    """Fetch the BGG infos for game_ids using multi-id thing requests.
+        Returns: A dict gameid (str) -> {"name": name, "expansion": bool,
+        "year": year}, games unknown to BGG or still failing after
+        retries are left out.
+        Raises: BGGOfflineError listing all game_ids if bgg is offline
+    """
+    if bgg is None:
+        bgg = BGGClient(retries=0)
+    if scheduler is None:
+        scheduler = RetryScheduler()
+    game_ids = [str(x) for x in game_ids]
+    if bgg.offline and game_ids:
+        raise bgg_api.BGGOfflineError(
+            "Offline, no info for games " + ", ".join(game_ids))
+    batches = [game_ids[start:start + batch_size]
+               for start in range(0, len(game_ids), batch_size)]
+
+    def fetch(batch):
+        print("Fetching info for games", ", ".join(batch))
+        with metrics.timed("thing"):
+            return bgg.games(batch)
+
+    game_infos = dict()
+    for batch, infos, error in scheduler.run(fetch, batches):
+        if error is not None:
+            print("No info available for games", ", ".join(batch),
+                  "-", error)
+            continue
+        game_infos.update(infos)
+    return game_infos
 
 
 def load_members_from_file(filename):
@@ -88,388 +148,652 @@ def load_members_from_file(filename):
     return members
 
 
-def get_all_ratings(members, bgg=None):
+class RateLimiter:
+    """Token bucket limiting the request rate of all fetch workers"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            metrics.count("rate_limit_wait", wait)
+            time.sleep(wait)
+
+
+def get_all_ratings(members, bgg=None, workers=1, rate=None,
+                    checkpoint=None, previous=None, scheduler=None,
+                    consume=None):
     """Get the ratings for all users in the list members.
-        Returns: A dict (gameid, game name) -> list of ratings
+        Failed members are retried by scheduler, members it gives up on
+        are reported and left out.
+        workers > 1 fetches concurrently, each worker using its own
+        connection of bgg; rate limits the requests per second of all
+        workers.
+        Each fetched member is appended to checkpoint if given, members
+        already stored in an opened checkpoint are not fetched again.
+        previous is the checkpoint of an earlier run, loaded if it may be
+        replaced by checkpoint: for members found there only the changes
+        since that run are fetched and merged.
+        consume(member, ratings) is called with the ratings of every
+        member instead of keeping them, resumed ones included.
+        Returns: A dict member -> dict gameid -> rating, the ratings are
+        None with consume
     """
     if bgg is None:
-        bgg = BGGClient()
+        bgg = BGGClient(retries=0)
+    if scheduler is None:
+        scheduler = RetryScheduler()
+    limiter = RateLimiter(rate) if rate else None
+    previous_ratings = dict()
+    if previous is not None:
+        if previous.ratings is None:
+            previous.load()
+        previous_ratings = previous.ratings
+        print("Fetching changes only for", len(previous_ratings),
+              "members of", previous.filename)
+
+    def fetch(member):
+        if limiter is not None:
+            limiter.acquire()
+        print("Fetching data for ", member)
+        if previous is not None and member in previous.fetched:
+            changes = get_user_rating_changes(
+                member, previous.fetched[member] - MODIFIED_SINCE_MARGIN,
+                bgg=bgg)
+            return merge_rating_changes(previous_ratings[member], changes)
+        return get_user_ratings(member, bgg=bgg)
+
+    def store(member, user_ratings):
+        if consume is not None:
+            consume(member, user_ratings)
+            user_ratings = None
+        all_member_ratings[member] = user_ratings
+
     all_member_ratings = dict()
+    if checkpoint is not None:
+        if consume is None:
+            all_member_ratings = checkpoint.load()
+        else:
+            wanted = set(members)
+            for member, user_ratings, _ in checkpoint.entries():
+                if member in wanted:
+                    store(member, user_ratings)
+        if all_member_ratings:
+            print("Resuming with", len(all_member_ratings),
+                  "members from", checkpoint.filename)
     print("Retrieving user ratings...")
-    work_queue = Queue()
-    retry_queue = Queue()
+    pending = [x for x in members if x not in all_member_ratings]
     fails = list()
-    for member in members:
-        work_queue.put(member)
-    while not work_queue.empty():
-        print(work_queue.qsize(), "members to process")
-        member = work_queue.get()
-        print("Fetching data for ", member)
-        try:
-            user_ratings = get_user_ratings(member, bgg=bgg)
-        except Exception:
-            retry_queue.put(member)
-            continue
-        all_member_ratings[member] = user_ratings
-    while not retry_queue.empty():
-        print(retry_queue.qsize(), "members to process")
-        member = retry_queue.get()
-        print("Fetching data for ", member)
-        try:
-            user_ratings = get_user_ratings(member, bgg=bgg)
-        except Exception:
-            print("No data available for ", member)
+    for done, (member, user_ratings, error) in enumerate(
+            scheduler.run(fetch, pending, workers), 1):
+        print(len(pending) - done, "members to process")
+        if error is not None:
+            print("No data available for ", member, "-", error)
             fails.append(member)
             continue
-        all_member_ratings[member] = user_ratings
+        if checkpoint is not None:
+            checkpoint.add(member, user_ratings)
+        store(member, user_ratings)
+    metrics.count("members_failed", len(fails))
     print("Ratings retrieved for all users except", fails)
-    return all_member_ratings
+    return {x: all_member_ratings[x]
+            for x in members if x in all_member_ratings}
 
 
-def collapse_ratings(member_ratings):
-    guild_ratings = dict()
-    for _, ratings in member_ratings.items():
-        add_individual_to_group_ratings(guild_ratings, ratings)
-    return guild_ratings
+def is_base_game(info):
+    return not info["expansion"]
 
 
-def main(b, n, s, guild, concat=False,
-         raw_data=None, prune=False, users=None):
-    if users is None or concat is True:
-        if guild == "hc":
-            guild_id = HEAVY_CARDBOARD
-        elif guild == "pc":
-            guild_id = PUNCHING_CARDBOARD
-        elif guild == "uk":
-            guild_id = UNKNOWNS
+def unknown_game_infos(games, count, game_infos, unavailable,
+                       accepts=is_base_game):
+    """Ids of games lacking infos that may be among the first count
+        games whose info accepts, assuming unknown ones are accepted.
+        Infos accepts cannot tell (None) about count as lacking.
+    """
+    unknown = list()
+    count_of_printed = 0
+    for game in games:
+        if count_of_printed >= count:
+            break
+        gameid = str(game[0])
+        if gameid in unavailable:
+            continue
+        game_info = game_infos.get(gameid)
+        accepted = None if game_info is None else accepts(game_info)
+        if accepted is None:
+            unknown.append(gameid)
+            count_of_printed += 1
+        elif accepted:
+            count_of_printed += 1
+    return unknown
+
+
+def resolve_game_infos(candidates, game_infos, bgg=None, scheduler=None):
+    """Fetch the infos needed to fill every (sorted games, count,
+        accepts) list of candidates in batches, adding them to game_infos.
+        Returns: The set of game ids for which no info is available
+    """
+    unavailable = set()
+    while True:
+        missing = set()
+        for games, count, accepts in candidates:
+            missing.update(unknown_game_infos(
+                games, count, game_infos, unavailable, accepts))
+        if not missing:
+            return unavailable
+        fetched = get_game_infos(sorted(missing, key=int), bgg,
+                                 scheduler=scheduler)
+        game_infos.update(fetched)
+        unavailable.update(missing - fetched.keys())
+
+
+def pick_games(games, count, game_infos, unavailable=(),
+               accepts=is_base_game):
+    """The first count games whose info accepts, by default no
+        expansions, as (name, gameid, num_ratings, avg_rating, sd_ratings)
+    """
+    picked = list()
+    for game in games:
+        if len(picked) >= count:
+            break
+        gameid = str(game[0])
+        if gameid in unavailable or not accepts(game_infos[gameid]):
+            continue
+        picked.append((game_infos[gameid]["name"],
+                       game[0], game[1], game[2], game[3]))
+    return picked
+
+
+def prune_games(all_games, rows):
+    """Match rows (gameid, name, ...) against all_games, rows may be
+        streamed from a large CSV file.
+        Returns: A list of (name, gameid, num_ratings, avg_rating,
+        sd_ratings) per row, zeros for games without ratings
+    """
+    index = {game[0]: game for game in all_games}
+    pruned_games = list()
+    for row in rows:
+        gameid = int(row[0])
+        match = index.get(gameid)
+        if match is None:
+            pruned_games.append((row[1], gameid, 0, 0, 0))
         else:
-            guild_id = guild
-        print("Guild:", guild, "=> id:", guild_id)
-    bgg = BGGClient()
-    # if not users and not raw_data: get users, get user ratings, process ratings
-    # if users and not raw_data: load users, get user ratings, process ratings
-    # if raw data: load users, load user ratings, process ratings
-    date_str = datetime.datetime.now().strftime("%Y%m%d")
-    if raw_data is None:
+            pruned_games.append(
+                (row[1], match[0], match[1], match[2], match[3]))
+    return pruned_games
+
+
+def resolve_guilds(guild):
+    """Guild ids for a comma separated list of guild ids or [pc, hc, uk]"""
+    guild_ids = list()
+    for name in guild.split(","):
+        name = name.strip()
+        guild_id = GUILDS.get(name, name)
+        print("Guild:", name, "=> id:", guild_id)
+        if guild_id not in guild_ids:
+            guild_ids.append(guild_id)
+    return guild_ids
+
+
+def output_name(prefix, guild_id, date_str, extension, several=False):
+    """prefix_YYYYMMDD.extension, with the guild id for several guilds"""
+    if several:
+        return "%s_%s_%s.%s" % (prefix, guild_id, date_str, extension)
+    return "%s_%s.%s" % (prefix, date_str, extension)
+
+
+def load_guild_members(guild_ids, users, concat, date_str, bgg=None,
+                       scheduler=None):
+    """Member lists per guild, from BGG, the users file or both.
+        Returns: A dict guild id -> list of members
+    """
+    several = len(guild_ids) > 1
+    guild_members = dict()
+    for guild_id in guild_ids:
         if concat is False:
             # load members from file or query for current list
             if users is None:
-                members = get_guild_user_list(guild_id, bgg=bgg)
-                of = open("members_" + date_str + ".txt", "w")
-                for member in members:
-                    of.write(member + "\n")
+                members = get_guild_user_list(
+                    guild_id, bgg=bgg, scheduler=scheduler)
             else:
                 members = load_members_from_file(users)
                 members = [member.lower() for member in members]
                 members = sorted(set(members))
+                guild_members[guild_id] = members
+                continue
         else:
             # concatenate members from file and guild members
             members_file = load_members_from_file(users)
-            members_guild = get_guild_user_list(guild_id, bgg=bgg)
+            members_guild = get_guild_user_list(
+                guild_id, bgg=bgg, scheduler=scheduler)
             members = members_file + members_guild
             members = [member.lower() for member in members]
             members = sorted(set(members))
-            of = open("members_" + date_str + ".txt", "w")
+        filename = output_name("members", guild_id, date_str, "txt", several)
+        with open(filename, "w") as of:
             for member in members:
                 of.write(member + "\n")
+        guild_members[guild_id] = members
+    return guild_members
 
-        guild_size = len(members)
-        print("Members list loaded: %d members" % guild_size)
-        member_ratings = get_all_ratings(members, bgg=bgg)
-        guild_ratings = collapse_ratings(member_ratings)
-
-        print("Processing results...")
-        print("%d games rated" % len(guild_ratings))
-        all_games = list()
-        for game_id, ratings in guild_ratings.items():
-            num_ratings = len(ratings)
-            avg_rating = round(mean(ratings), 3)
-            if num_ratings > 1:
-                sd_ratings = round(stdev(ratings), 3)
-            else:
-                sd_ratings = 0
-            all_games.append((game_id, num_ratings, avg_rating, sd_ratings))
-
-        # Sort the list
-        all_games.sort(key=lambda x: x[2], reverse=True)
-
-        # Write out the raw data to this point
-        current_time_str = str(datetime.datetime.now())
-        rating_data = dict()
-        rating_data[SUMMARY] = {GUILD_MEMBER_COUNT: guild_size,
-                                TOTAL_GAMES: len(guild_ratings),
-                                TIME: current_time_str
-                                }
-        rating_data[MEMBERS] = members
-        rating_data[SORTED_GAMES] = all_games
-        with open("guild_data_" + date_str + ".json", "w") as raw_data_file:
-            json.dump(rating_data, raw_data_file)
-        with open("member_data_" + date_str + ".yml", "w") as raw_data_file:
-            yaml.dump(member_ratings, raw_data_file)
-    elif raw_data is not None:
-        rating_data = json.load(open(raw_data, "r"))
 
-    # Either path we now have rating_data
+def build_rating_data(members, member_ratings=None, all_games=None,
+                      normalized=None):
+    """The rating data of a guild for guild_data_YYYYMMDD.json,
+        member_ratings may hold the ratings of other guilds' members.
+        all_games and normalized (gameid -> mean z-score) are the already
+        aggregated ratings of the members, e.g. of a RatingAccumulator,
+        instead of member_ratings.
+    """
+    if all_games is None:
+        guild_ratings = {x: member_ratings[x]
+                         for x in members if x in member_ratings}
+        all_games = aggregate_ratings(guild_ratings)
+        normalized = normalized_means(guild_ratings)
+    print("%d games rated" % len(all_games))
+
+    # Sort the list
+    all_games.sort(key=lambda x: x[2], reverse=True)
+
+    current_time_str = str(datetime.datetime.now())
+    rating_data = dict()
+    rating_data[SUMMARY] = {GUILD_MEMBER_COUNT: len(members),
+                            TOTAL_GAMES: len(all_games),
+                            TIME: current_time_str
+                            }
+    rating_data[MEMBERS] = members
+    rating_data[SORTED_GAMES] = all_games
+    if normalized is not None:
+        rating_data[NORMALIZED_MEANS] = [round(normalized[x[0]], 3)
+                                         for x in all_games]
+    return rating_data
+
+
+def print_pruned(all_games, prune):
+    """Print the rating data of the games in the csv file prune"""
+    with open(prune, "r", newline="") as f:
+        pruned_games = prune_games(all_games, csv.reader(f))
+    pruned_games.sort(key=lambda x: x[3], reverse=True)
+
+    max_name_width = max([len(game[0]) for game in pruned_games])
+    format_string_prefix = "{:2} {:"
+    format_string_suffix = "} {:3} {:5.3f} {:5.3f}"
+    format_string = format_string_prefix + \
+        str(max_name_width) + format_string_suffix
+    for idx, game in enumerate(pruned_games):
+        detail_string = format_string.format(idx + 1,
+                                             game[0],
+                                             game[2],
+                                             game[3],
+                                             game[4])
+        print(detail_string)
+
+
+def build_lists(rating_data, b, n, s, game_infos, bgg=None,
+                scheduler=None, specs=list_specs.DEFAULT_SPECS,
+                prior_weight=DEFAULT_PRIOR_WEIGHT):
+    """Select the lists of specs from a guild's rating data, fetching the
+        missing infos of the selected games into game_infos. prior_weight
+        is the number of guild mean ratings added for the bayes column.
+    """
     all_games = rating_data[SORTED_GAMES]
     member_count = rating_data[SUMMARY][GUILD_MEMBER_COUNT]
 
-    # If we want to prune the games
-    if prune is True:
-        pruned_games = list()
-        with open(prune, "r") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                gameid = int(row[0])
-                matches = [x for x in all_games if x[0] == gameid]
-                if len(matches) == 1:
-                    match = matches[0]
-                    matched_game = (
-                        row[1], match[0], match[1], match[2], match[3])
-                elif len(matches) == 0:
-                    matched_game = (row[1], gameid, 0, 0, 0)
-                else:
-                    print("ERROR")
-                    return
-                pruned_games.append(matched_game)
-        pruned_games.sort(key=lambda x: x[3], reverse=True)
-
-        max_name_width = max([len(game[0]) for game in pruned_games])
-        format_string_prefix = "{:2} {:"
-        format_string_suffix = "} {:3} {:5.3f} {:5.3f}"
-        format_string = format_string_prefix + \
-            str(max_name_width) + format_string_suffix
-        for idx, game in enumerate(pruned_games):
-            detail_string = format_string.format(idx + 1,
-                                                 game[0],
-                                                 game[2],
-                                                 game[3],
-                                                 game[4])
-            print(detail_string)
-        return
+    # Keys reproduce the former chain of stable sorts over the games
+    # ordered by mean: each list breaks ties like the previous one
+    columns = {
+        name: np.fromiter(map(itemgetter(index), all_games),
+                          dtype=np.float64, count=len(all_games))
+        for name, index in list_specs.COLUMNS.items()}
+    columns["bayes"] = bayesian_means(columns["ratings"], columns["mean"],
+                                      prior_weight)
+    columns["lower"], columns["upper"] = confidence_bounds(
+        columns["ratings"], columns["mean"], columns["sd"])
+    if NORMALIZED_MEANS in rating_data:
+        columns["z"] = np.asarray(rating_data[NORMALIZED_MEANS],
+                                  dtype=np.float64)
+    counts = {"b": b, "n": n, "s": s}
+    selections = [
+        (list_specs.spec_count(spec, counts),
+         list_specs.accepted(spec, columns, member_count),
+         list_specs.sort_keys(spec, columns),
+         list_specs.info_filter(spec))
+        for spec in specs]
+
+    # Select some spare candidates per list for rejected games, select
+    # again with twice as many for lists which still come up short
+    sizes = [count + count // 2 + 5 for count, _, _, _ in selections]
+    candidates = [None] * len(selections)
+    pending = list(range(len(selections)))
+    while pending:
+        with metrics.phase("select"):
+            for i in pending:
+                _, accept, keys, _ = selections[i]
+                candidates[i] = [all_games[x] for x in
+                                 select_smallest(keys, accept, sizes[i])]
+        with metrics.phase("game_infos"):
+            unavailable = resolve_game_infos(
+                [(games, selections[i][0], selections[i][3])
+                 for i, games in enumerate(candidates)],
+                game_infos, bgg, scheduler)
+        pending = [
+            i for i in pending
+            if len(candidates[i]) == sizes[i]
+            and len(pick_games(candidates[i], selections[i][0], game_infos,
+                               unavailable, selections[i][3]))
+            < selections[i][0]]
+        for i in pending:
+            sizes[i] *= 2
+
+    lists_dict = dict()
+    lists_dict["lists"] = []
+    for spec, (count, _, _, accepts), games in zip(
+            specs, selections, candidates):
+        entry = {"category": spec["category"], "count": count,
+                 "games": pick_games(games, count, game_infos, unavailable,
+                                     accepts)}
+        if "title" in spec:
+            entry["title"] = spec["title"]
+        lists_dict["lists"].append(entry)
+    return lists_dict
+
+
+def checkpoint_filename(date_str, resume=None):
+    """The checkpoint a run on date_str appends to"""
+    return resume or "member_data_" + date_str + ".jsonl"
+
+
+def main(b, n, s, guild, concat=False,
+         raw_data=None, prune=None, users=None, workers=1, rate=None,
+         resume=None, incremental=None,
+         cache=game_cache.DEFAULT_FILENAME, cache_ttl=game_cache.DEFAULT_TTL,
+         history_db=history.DEFAULT_FILENAME, metrics_out=None,
+         api=bgg_api.DEFAULT_ENDPOINT, retry_budget=retry.DEFAULT_BUDGET,
+         streaming=False, offline=False, specs=list_specs.DEFAULT_SPECS,
+         ranking="mean", prior_weight=DEFAULT_PRIOR_WEIGHT):
+    run_metrics = metrics.reset()
+    if guild is not None and (users is None or concat is True):
+        guild_ids = resolve_guilds(guild)
+    elif users is None or concat is True:
+        guild_ids = [guild]
     else:
-        top_games = [x for x in all_games if x[1] >= 0.1 * member_count]
-        sleeper_games = [
-            x for x in all_games
-            if x[1] < 0.1 * member_count
-            and x[1] >= 0.02 * member_count
-            and x[2] >= 7.5]
-
-    # get game infos from file if possible, else create dict
-    filename = "game_infos.json"
-    try:
-        with open(filename, "r") as fi:
-            game_infos = json.load(fi)
-    except IOError:
-        print("Could not open ", filename, ", creating new dict()", sep="")
-        game_infos = dict()
-
-    # Get the top x
-    print("TOP")
-    top = list()
-    top_games.sort(key=lambda x: x[2], reverse=True)
-    count_of_printed = 0
-    for game in top_games:
-        gameid = str(game[0])
-        # game_name available from file else load from BGG
-        try:
-            game_name = game_infos[gameid]["name"]
-            print("Read info for game", gameid, "from", filename)
-            if not game_infos[gameid]["expansion"]:
-                count_of_printed += 1
-                top.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                top.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > n - 1:
-            break
-    # Get the bottom x
-    print("BOTTOM")
-    bottom = list()
-    top_games.sort(key=lambda x: x[2])
-    count_of_printed = 0
-    for game in top_games:
-        gameid = str(game[0])
-        try:
-            game_name = game_infos[gameid]["name"]
-            if not game_infos[gameid]["expansion"]:
-                print("Read info for game", gameid, "from", filename)
-                count_of_printed += 1
-                bottom.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                bottom.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > b - 1:
-            break
-    # Get the most variable
-    print("VARIANCE")
-    variance = list()
-    top_games.sort(key=lambda x: x[3], reverse=True)
-    count_of_printed = 0
-    for game in top_games:
-        gameid = str(game[0])
-        try:
-            game_name = game_infos[gameid]["name"]
-            if not game_infos[gameid]["expansion"]:
-                print("Read info for game", gameid, "from", filename)
-                count_of_printed += 1
-                variance.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                variance.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > b - 1:
-            break
-    # Get the least variable
-    print("SIMILAR")
-    similar = list()
-    top_games.sort(key=lambda x: x[3], reverse=False)
-    count_of_printed = 0
-    for game in top_games:
-        gameid = str(game[0])
-        try:
-            game_name = game_infos[gameid]["name"]
-            if not game_infos[gameid]["expansion"]:
-                print("Read info for game", gameid, "from", filename)
-                count_of_printed += 1
-                similar.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                similar.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > b - 1:
-            break
-    # Get the most rated
-    print("MOST RATED")
-    most_rated = list()
-    top_games.sort(key=lambda x: x[1], reverse=True)
-    count_of_printed = 0
-    for game in top_games:
-        gameid = str(game[0])
-        try:
-            game_name = game_infos[gameid]["name"]
-            if not game_infos[gameid]["expansion"]:
-                print("Read info for game", gameid, "from", filename)
-                count_of_printed += 1
-                most_rated.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                most_rated.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > b - 1:
-            break
-    # Get sleepers
-    print("SLEEPERS")
-    sleepers = list()
-    sleeper_games.sort(key=lambda x: x[2], reverse=True)
-    count_of_printed = 0
-    for game in sleeper_games:
-        gameid = str(game[0])
+        guild_ids = [guild or "users"]
+    several = len(guild_ids) > 1
+    # Failed requests are retried by the scheduler, not by the client
+    bgg = BGGClient(api, retries=0, offline=offline)
+    scheduler = RetryScheduler(budget=retry_budget)
+    # if not users and not raw_data: get users, get user ratings, process ratings
+    # if users and not raw_data: load users, get user ratings, process ratings
+    # if raw data: load users, load user ratings, process ratings
+    # Members of several guilds are fetched once for all of them
+    date_str = datetime.datetime.now().strftime("%Y%m%d")
+    checkpoint_file = checkpoint_filename(date_str, resume)
+    if (raw_data is None and incremental is not None
+            and same_file(incremental, checkpoint_file)):
+        raise ValueError("%s is the checkpoint of this run, it cannot be "
+                         "the baseline of --incremental" % incremental)
+    if raw_data is None:
+        with metrics.phase("members"):
+            guild_members = load_guild_members(
+                guild_ids, users, concat, date_str, bgg=bgg,
+                scheduler=scheduler)
+        members = list(dict.fromkeys(
+            member for guild_id in guild_ids
+            for member in guild_members[guild_id]))
+        print("Members list loaded: %d members" % len(members))
+        if several:
+            print("%d memberships in %d guilds" % (
+                sum(map(len, guild_members.values())), len(guild_ids)))
+        # The baseline is read before a new checkpoint may be created
+        previous = None
+        if incremental is not None:
+            previous = RatingCheckpoint(incremental)
+            previous.load()
+        checkpoint = RatingCheckpoint(checkpoint_file)
+        checkpoint.open(resume=resume is not None)
+        consume = None
+        if streaming:
+            # Fold every collection into its guilds' statistics as it
+            # arrives, the raw ratings are only kept in the checkpoint
+            accumulators = dict()
+            memberships = dict()
+            for guild_id in guild_ids:
+                accumulators[guild_id] = RatingAccumulator()
+                for rank, member in enumerate(guild_members[guild_id]):
+                    memberships.setdefault(member, []).append(
+                        (accumulators[guild_id], rank))
+
+            def accumulate(member, user_ratings):
+                for accumulator, rank in memberships[member]:
+                    accumulator.add(user_ratings, rank)
+            consume = accumulate
         try:
-            game_name = game_infos[gameid]["name"]
-            if not game_infos[gameid]["expansion"]:
-                print("Read info for game", gameid, "from", filename)
-                count_of_printed += 1
-                sleepers.append(
-                    (game_name, game[0], game[1], game[2], game[3]))
-        except KeyError:
-            game_info = get_game_info(gameid, bgg)
-            game_infos[gameid] = {"name": game_info.name,
-                                  "expansion": game_info.expansion}
-            if not game_info.expansion:
-                count_of_printed += 1
-                sleepers.append(
-                    (game_info.name, game[0], game[1], game[2], game[3]))
-        if count_of_printed > s - 1:
-            break
+            with metrics.phase("ratings"):
+                member_ratings = get_all_ratings(
+                    members, bgg=bgg, workers=workers, rate=rate,
+                    checkpoint=checkpoint, previous=previous,
+                    scheduler=scheduler, consume=consume)
+        finally:
+            checkpoint.close()
+        metrics.count("members", len(members))
+        if not streaming:
+            with metrics.phase("write_data"):
+                write_snapshot("member_data_" + date_str + ".snap",
+                               member_ratings)
 
-    # save game_infos
-    with open(filename, "w") as fi:
-        json.dump(game_infos, fi)
+        print("Processing results...")
+        runs = list()
+        store = history.HistoryStore(history_db)
+        for guild_id in guild_ids:
+            with metrics.phase("aggregation"):
+                if streaming:
+                    # Values close to a rounding boundary are recomputed
+                    # from the checkpoint
+                    guild = set(guild_members[guild_id])
+                    all_games = accumulators[guild_id].aggregate(
+                        ratings for member, ratings, _
+                        in RatingCheckpoint(checkpoint.filename).entries()
+                        if member in guild)
+                    rating_data = build_rating_data(
+                        guild_members[guild_id], all_games=all_games,
+                        normalized=accumulators[guild_id].normalized_means())
+                else:
+                    rating_data = build_rating_data(
+                        guild_members[guild_id], member_ratings)
+            # Write out the raw data to this point
+            filename = output_name(
+                "guild_data", guild_id, date_str, "json", several)
+            with metrics.phase("write_data"):
+                with open(filename, "w") as raw_data_file:
+                    json.dump(rating_data, raw_data_file)
+                store.add_run(
+                    guild_id, history.iso_date(date_str), rating_data)
+            runs.append((guild_id, rating_data))
+        store.close()
+    elif raw_data is not None:
+        runs = [(guild_ids[0], json.load(open(raw_data, "r")))]
 
-    # save lists
-    lists_dict = dict()
-    lists_dict["lists"] = []
-    lists_dict["lists"].append(
-        {"category": "top", "count": n, "games": top})
-    lists_dict["lists"].append(
-        {"category": "bottom", "count": b, "games": bottom})
-    lists_dict["lists"].append({
-        "category": "variance", "count": b, "games": variance})
-    lists_dict["lists"].append(
-        {"category": "similar", "count": b, "games": similar})
-    lists_dict["lists"].append({
-        "category": "most_rated", "count": b, "games": most_rated})
-    lists_dict["lists"].append(
-        {"category": "sleepers", "count": s, "games": sleepers})
-    with open("lists_" + date_str + ".json", "w") as fi:
-        json.dump(lists_dict, fi)
+    # Either path we now have rating_data
+    # If we want to prune the games
+    if prune:
+        for guild_id, rating_data in runs:
+            if several:
+                print("Guild:", guild_id)
+            print_pruned(rating_data[SORTED_GAMES], prune)
+        if metrics_out is not None:
+            run_metrics.write(metrics_out)
+        return
+
+    # The game infos are shared by the lists of all guilds
+    game_infos = game_cache.GameInfoCache(cache, ttl=cache_ttl)
+    store = history.HistoryStore(history_db) if raw_data is None else None
+    specs = list_specs.rank_by(specs, ranking)
+    for guild_id, rating_data in runs:
+        lists_dict = build_lists(rating_data, b, n, s, game_infos, bgg,
+                                 scheduler, specs, prior_weight)
+        # save lists
+        filename = output_name("lists", guild_id, date_str, "json", several)
+        with metrics.phase("write_lists"):
+            with open(filename, "w") as fi:
+                json.dump(lists_dict, fi)
+            if store is not None:
+                store.add_lists(
+                    guild_id, history.iso_date(date_str), lists_dict)
+    if store is not None:
+        store.close()
+    metrics.count("game_info_cache_hits", len(game_infos.hits))
+    metrics.count("game_info_cache_misses", len(game_infos.misses))
+    game_infos.report()
+    game_infos.close()
+    if metrics_out is not None:
+        run_metrics.write(metrics_out)
     print("Finished")
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--api", default=bgg_api.DEFAULT_ENDPOINT,
+        help="BGG XML API endpoint, default=" + bgg_api.DEFAULT_ENDPOINT)
     parser.add_argument(
         "-b", type=int, default=10,
         help="output the bottom, most/least variable & most rated B games")
+    parser.add_argument(
+        "--cache", default=game_cache.DEFAULT_FILENAME,
+        help="game info cache, default=" + game_cache.DEFAULT_FILENAME)
+    parser.add_argument(
+        "--cache-ttl", type=float, default=game_cache.DEFAULT_TTL / 86400,
+        help="refetch game infos older than CACHE_TTL days, default=90")
     parser.add_argument(
         "-c", "--concat",
         action="store_true",
         help="concatenate lists of users and guild members")
     parser.add_argument(
         "-g", "--guild",
-        help="guild-id or one of [pc, hc, uk]")
+        help="guild-id or one of [pc, hc, uk], several comma separated "
+             "guilds share the collection fetches of common members")
+    parser.add_argument(
+        "--history", default=history.DEFAULT_FILENAME,
+        help="add the run to HISTORY, default=" + history.DEFAULT_FILENAME)
+    parser.add_argument(
+        "-i", "--incremental",
+        help="INCREMENTAL = member_data_YYYYMMDD.jsonl of a previous run, "
+             "only fetch collection changes since then")
+    parser.add_argument(
+        "--lists",
+        help="LISTS = JSON file of list specs replacing the default lists, "
+             "see list_specs.py")
+    parser.add_argument(
+        "--metrics-out",
+        help="write phase timings, request counts and latencies as JSON "
+             "to METRICS_OUT")
     parser.add_argument(
         "-n", type=int, default=50,
         help="output the top N games, default=50")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="regenerate from RAW without requests to BGG, fail if game "
+             "infos are missing from the cache")
+    parser.add_argument(
+        "--prior-weight", type=float, default=DEFAULT_PRIOR_WEIGHT,
+        help="guild mean ratings added to every game for --rank-by bayes, "
+             "default=%d" % DEFAULT_PRIOR_WEIGHT)
     parser.add_argument(
         "-p", "--prune",
-        action="store_true",
-        help="prune raw data to a specific list of games")
+        help="PRUNE = csv file (gameid, name) to prune raw data to")
+    parser.add_argument(
+        "--rate", type=float,
+        help="limit collection requests of all workers to RATE per second")
     parser.add_argument(
         "-r", "--raw",
         help="RAW = guild_data_YYYYMMDD.json to regenerate final data")
+    parser.add_argument(
+        "--retry-budget", type=int, default=retry.DEFAULT_BUDGET,
+        help="retry at most RETRY_BUDGET failed requests per run, "
+             "default=%d" % retry.DEFAULT_BUDGET)
     parser.add_argument(
         "-s", type=int, default=50,
         help="output the top S sleepers, default=50")
+    parser.add_argument(
+        "--rank-by", choices=list_specs.RANKINGS, default="mean",
+        help="order the lists by mean, Bayesian average (bayes), the "
+             "confidence bound of the mean or the mean of the ratings "
+             "z-scored per member (z), default=mean")
+    parser.add_argument(
+        "--resume",
+        help="RESUME = member_data_YYYYMMDD.jsonl to continue an aborted run")
+    parser.add_argument(
+        "--streaming", action="store_true",
+        help="aggregate each collection as it arrives instead of keeping "
+             "all ratings in memory, no member_data_YYYYMMDD.snap is "
+             "written")
     parser.add_argument(
         "-u", "--users",
         help="use provided list of users instead of pulling a new one")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1,
+        help="fetch W collections concurrently, default=1")
     args = parser.parse_args()
+    if args.raw and args.guild and "," in args.guild:
+        parser.error("RAW holds the data of a single guild")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.offline and not args.raw:
+        parser.error("--offline needs RAW data")
+    if args.incremental and not args.raw and same_file(
+            args.incremental, checkpoint_filename(
+                datetime.datetime.now().strftime("%Y%m%d"), args.resume)):
+        parser.error("INCREMENTAL is the checkpoint this run writes to, "
+                     "rename it first")
+    specs = list_specs.DEFAULT_SPECS
+    if args.lists:
+        try:
+            specs = list_specs.load_specs(args.lists)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
 
-    main(
-        b=args.b,
-        concat=args.concat,
-        guild=args.guild,
-        n=args.n,
-        prune=args.prune,
-        raw_data=args.raw,
-        s=args.s,
-        users=args.users)
+    try:
+        main(
+            b=args.b,
+            concat=args.concat,
+            guild=args.guild,
+            n=args.n,
+            prune=args.prune,
+            raw_data=args.raw,
+            s=args.s,
+            users=args.users,
+            workers=args.workers,
+            rate=args.rate,
+            resume=args.resume,
+            incremental=args.incremental,
+            cache=args.cache,
+            cache_ttl=args.cache_ttl * 86400,
+            history_db=args.history,
+            metrics_out=args.metrics_out,
+            api=args.api,
+            retry_budget=args.retry_budget,
+            streaming=args.streaming,
+            offline=args.offline,
+            specs=specs,
+            ranking=args.rank_by,
+            prior_weight=args.prior_weight)
+    except (bgg_api.BGGOfflineError, list_specs.SpecError) as e:
+        parser.exit(1, "%s\n" % e)
@@ -0,0 +1,233 @@
+# Store of all guild runs for questions across time
+#
+# Every run of generate_lists.py is added to an SQLite database indexed
+# by guild, date and game id, existing guild_data_YYYYMMDD.json and
+# lists_YYYYMMDD.json files can be imported.
+
+import json
+import os
+import re
+import sqlite3
+
+DEFAULT_FILENAME = "guild_history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    guild TEXT NOT NULL,
+    date TEXT NOT NULL,
+    members INTEGER,
+    total_games INTEGER,
+    generated TEXT,
+    joined INTEGER,
+    departed INTEGER,
+    UNIQUE (guild, date));
+CREATE TABLE IF NOT EXISTS game_stats (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    game INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    num_ratings INTEGER NOT NULL,
+    avg_rating REAL NOT NULL,
+    sd_ratings REAL NOT NULL,
+    PRIMARY KEY (run, game)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS game_stats_game ON game_stats(game, run);
+CREATE TABLE IF NOT EXISTS memberships (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    member TEXT NOT NULL,
+    PRIMARY KEY (run, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS list_entries (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    category TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    game INTEGER NOT NULL,
+    PRIMARY KEY (run, category, rank)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS list_entries_game
+    ON list_entries(game, category, run);
+"""
+
+
+def iso_date(date_str):
+    """YYYYMMDD -> YYYY-MM-DD"""
+    return date_str[:4] + "-" + date_str[4:6] + "-" + date_str[6:8]
+
+
+def file_date(filename):
+    """The date of a guild_data_YYYYMMDD.json or lists_YYYYMMDD.json"""
+    match = re.search(r"(\d{8})\D*$", os.path.basename(filename))
+    if match is None:
+        raise ValueError("No date in file name " + filename)
+    return iso_date(match.group(1))
+
+
+class HistoryStore:
+    """Runs of one or several guilds, dates as YYYY-MM-DD"""
+
+    def __init__(self, filename=DEFAULT_FILENAME):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def run_id(self, guild, date):
+        row = self.conn.execute(
+            "SELECT id FROM runs WHERE guild = ? AND date = ?",
+            (str(guild), date)).fetchone()
+        return None if row is None else row[0]
+
+    def add_run(self, guild, date, rating_data):
+        """Store the rating data (as in guild_data_YYYYMMDD.json) of a
+            run, replacing an earlier run of guild on date.
+            Returns: The id of the run
+        """
+        summary = rating_data["summary"]
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM runs WHERE guild = ? AND date = ?",
+                (str(guild), date))
+            run = self.conn.execute(
+                "INSERT INTO runs (guild, date, members, total_games, "
+                "generated) VALUES (?, ?, ?, ?, ?)",
+                (str(guild), date, summary["guild_members"],
+                 summary["total_games_rated"],
+                 summary["time_at_generation"])).lastrowid
+            self.conn.executemany(
+                "INSERT INTO game_stats VALUES (?, ?, ?, ?, ?, ?)",
+                ((run, game[0], rank, game[1], game[2], game[3])
+                 for rank, game in enumerate(rating_data["sorted_games"])))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO memberships VALUES (?, ?)",
+                ((run, member) for member in rating_data["members"]))
+            self.update_churn(guild, date)
+        return run
+
+    def members(self, run):
+        return {row[0] for row in self.conn.execute(
+            "SELECT member FROM memberships WHERE run = ?", (run,))}
+
+    def update_churn(self, guild, date):
+        """Count the members joined and departed since the previous run
+            for the run on date and the one after it
+        """
+        rows = self.conn.execute(
+            "SELECT id, date FROM runs r WHERE guild = ? AND EXISTS ("
+            "SELECT 1 FROM memberships m WHERE m.run = r.id) "
+            "ORDER BY date", (str(guild),)).fetchall()
+        dates = [row[1] for row in rows]
+        if date not in dates:
+            return
+        position = dates.index(date)
+        for i in range(position, min(position + 2, len(rows))):
+            current = self.members(rows[i][0])
+            previous = self.members(rows[i - 1][0]) if i > 0 else current
+            self.conn.execute(
+                "UPDATE runs SET joined = ?, departed = ? WHERE id = ?",
+                (len(current - previous), len(previous - current),
+                 rows[i][0]))
+
+    def add_lists(self, guild, date, lists):
+        """Store the lists (as in lists_YYYYMMDD.json) of a run, the run
+            is created if it is not stored yet
+        """
+        run = self.run_id(guild, date)
+        with self.conn:
+            if run is None:
+                run = self.conn.execute(
+                    "INSERT INTO runs (guild, date) VALUES (?, ?)",
+                    (str(guild), date)).lastrowid
+            self.conn.execute(
+                "DELETE FROM list_entries WHERE run = ?", (run,))
+            self.conn.executemany(
+                "INSERT INTO list_entries VALUES (?, ?, ?, ?)",
+                ((run, entry["category"], rank, game[1])
+                 for entry in lists["lists"]
+                 for rank, game in enumerate(entry["games"])))
+        return run
+
+    def import_files(self, guild, filenames):
+        """Import guild_data_*.json and lists_*.json files of guild"""
+        for filename in sorted(filenames):
+            with open(filename, "r") as fi:
+                data = json.load(fi)
+            if "lists" in data:
+                self.add_lists(guild, file_date(filename), data)
+            else:
+                self.add_run(guild, file_date(filename), data)
+            print("Imported", filename)
+
+    def game_history(self, guild, game_id):
+        """Returns: A list of (date, rank by mean, num_ratings,
+            avg_rating, sd_ratings) of all runs rating game_id
+        """
+        return self.conn.execute(
+            "SELECT r.date, s.rank + 1, s.num_ratings, s.avg_rating, "
+            "s.sd_ratings FROM game_stats s JOIN runs r ON r.id = s.run "
+            "WHERE s.game = ? AND r.guild = ? ORDER BY r.date",
+            (game_id, str(guild))).fetchall()
+
+    def rank_history(self, guild, game_id, category="top"):
+        """Returns: A list of (date, rank or None) of game_id in the
+            category list of all runs with lists
+        """
+        return self.conn.execute(
+            "SELECT r.date, e.rank + 1 FROM runs r "
+            "LEFT JOIN list_entries e ON e.run = r.id "
+            "AND e.category = ? AND e.game = ? "
+            "WHERE r.guild = ? AND EXISTS ("
+            "SELECT 1 FROM list_entries x WHERE x.run = r.id "
+            "AND x.category = ?) ORDER BY r.date",
+            (category, game_id, str(guild), category)).fetchall()
+
+    def membership_churn(self, guild):
+        """Returns: A list of (date, members, joined, departed) per run
+            with a member list, compared to the run before
+        """
+        return self.conn.execute(
+            "SELECT date, members, joined, departed FROM runs "
+            "WHERE guild = ? AND joined IS NOT NULL ORDER BY date",
+            (str(guild),)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Query or fill the history of guild runs")
+    parser.add_argument(
+        "--db", default=DEFAULT_FILENAME,
+        help="history database, default=" + DEFAULT_FILENAME)
+    parser.add_argument(
+        "-g", "--guild", required=True,
+        help="guild as given to generate_lists.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    importer = subparsers.add_parser(
+        "import", help="import guild_data_*.json and lists_*.json files")
+    importer.add_argument("files", nargs="+")
+    game = subparsers.add_parser(
+        "game", help="ratings of a game over all runs")
+    game.add_argument("game_id", type=int)
+    ranks = subparsers.add_parser(
+        "ranks", help="ranks of a game in a list over all runs")
+    ranks.add_argument("game_id", type=int)
+    ranks.add_argument("--category", default="top")
+    subparsers.add_parser(
+        "churn", help="members joining and leaving between runs")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.db)
+    if args.command == "import":
+        store.import_files(args.guild, args.files)
+    elif args.command == "game":
+        for row in store.game_history(args.guild, args.game_id):
+            print("{} {:5} {:4} {:5.3f} {:5.3f}".format(*row))
+    elif args.command == "ranks":
+        for date, rank in store.rank_history(
+                args.guild, args.game_id, args.category):
+            print(date, "-" if rank is None else rank)
+    else:
+        for row in store.membership_churn(args.guild):
+            print("{} {:5} +{:<4} -{:<4}".format(*row))
+    store.close()
@@ -0,0 +1,174 @@
+# Declarative definitions of the generated lists
+#
+# A spec tells which games qualify for a list by their rating statistics
+# and game info, how they are ordered and how many are listed.
+# generate_lists.py evaluates all specs in one pipeline, more lists can
+# be defined in a JSON file instead of code:
+#
+#   [{"category": "classics", "title": "Classics", "count": 20,
+#     "min_share": 0.05, "max_year": 2000, "sort": ["-mean", "sd"]}]
+#
+# category: key of the list in lists_YYYYMMDD.json
+# title: headline of categories print_lists.py does not know
+# count: number of games or "n", "b", "s" for the command line values
+# sort: columns ratings, mean, sd, bayes (Bayesian average), lower and
+#   upper (confidence bounds of the mean) and z (mean of the ratings
+#   z-scored per member), descending with a leading "-", ties keep the
+#   order of the games by mean
+# min_X / max_X: X >= min_X and X < max_X for X in share (of the
+#   members who rated the game), mean, sd and year
+# expansions: "exclude" (default), "include" or "only"
+
+import json
+
+COLUMNS = {"ratings": 1, "mean": 2, "sd": 3}
+RANKING_COLUMNS = ("bayes", "lower", "upper", "z")
+# sort columns replacing the mean for descending and ascending orders
+RANKINGS = {"mean": ("mean", "mean"), "bayes": ("bayes", "bayes"),
+            "confidence": ("lower", "upper"), "z": ("z", "z")}
+BOUNDS = ("share", "mean", "sd", "year")
+EXPANSION_POLICIES = ("exclude", "include", "only")
+KEYS = {"category", "title", "count", "sort", "expansions"} | {
+    prefix + bound for prefix in ("min_", "max_") for bound in BOUNDS}
+
+DEFAULT_SPECS = (
+    {"category": "top", "count": "n", "min_share": 0.1, "sort": ["-mean"]},
+    {"category": "bottom", "count": "b", "min_share": 0.1, "sort": ["mean"]},
+    {"category": "variance", "count": "b", "min_share": 0.1,
+     "sort": ["-sd", "mean"]},
+    {"category": "similar", "count": "b", "min_share": 0.1,
+     "sort": ["sd", "mean"]},
+    {"category": "most_rated", "count": "b", "min_share": 0.1,
+     "sort": ["-ratings", "sd", "mean"]},
+    {"category": "sleepers", "count": "s", "min_share": 0.02,
+     "max_share": 0.1, "min_mean": 7.5, "sort": ["-mean"]},
+)
+
+
+class SpecError(ValueError):
+    """Invalid list spec or one the rating data cannot serve"""
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_spec(spec):
+    """Raises ValueError if spec is no valid list spec"""
+    if not isinstance(spec, dict) or "category" not in spec:
+        raise SpecError("List spec without category: %r" % (spec,))
+    name = spec["category"]
+    unknown = set(spec) - KEYS
+    if unknown:
+        raise SpecError("List spec %s: unknown keys %s"
+                        % (name, ", ".join(sorted(unknown))))
+    count = spec.get("count")
+    if not (count in ("n", "b", "s")
+            or isinstance(count, int) and not isinstance(count, bool)
+            and count >= 0):
+        raise SpecError("List spec %s: count must be a number or n, b, s"
+                        % name)
+    sort = spec.get("sort")
+    columns = list(COLUMNS) + list(RANKING_COLUMNS)
+    if not isinstance(sort, list) or not sort or any(
+            not isinstance(x, str) or x.lstrip("-") not in columns
+            for x in sort):
+        raise SpecError("List spec %s: sort by %s"
+                        % (name, ", ".join(columns)))
+    for bound in BOUNDS:
+        for key in ("min_" + bound, "max_" + bound):
+            if key in spec and not is_number(spec[key]):
+                raise SpecError("List spec %s: %s must be a number"
+                                % (name, key))
+    if spec.get("expansions", "exclude") not in EXPANSION_POLICIES:
+        raise SpecError("List spec %s: expansions must be one of %s"
+                        % (name, ", ".join(EXPANSION_POLICIES)))
+
+
+def load_specs(filename):
+    """Returns: The checked list specs of a JSON file holding a list of
+        specs or {"lists": specs}
+    """
+    with open(filename, "r") as fi:
+        specs = json.load(fi)
+    if isinstance(specs, dict):
+        specs = specs.get("lists")
+    if not isinstance(specs, list):
+        raise SpecError("%s holds no list of specs" % filename)
+    for spec in specs:
+        check_spec(spec)
+    categories = [spec["category"] for spec in specs]
+    if len(set(categories)) < len(categories):
+        raise SpecError("%s defines a category twice" % filename)
+    return specs
+
+
+def spec_count(spec, counts):
+    """Returns: The number of games of spec, counts maps n, b, s"""
+    count = spec["count"]
+    return counts[count] if isinstance(count, str) else count
+
+
+def accepted(spec, columns, member_count):
+    """Boolean array of the games passing the rating bounds of spec,
+        columns maps ratings, mean, sd to arrays
+    """
+    accept = columns["ratings"] >= 0
+    values = {"share": columns["ratings"], "mean": columns["mean"],
+              "sd": columns["sd"]}
+    scale = {"share": member_count}
+    for bound, column in values.items():
+        if "min_" + bound in spec:
+            accept &= column >= spec["min_" + bound] * scale.get(bound, 1)
+        if "max_" + bound in spec:
+            accept &= column < spec["max_" + bound] * scale.get(bound, 1)
+    return accept
+
+
+def sort_keys(spec, columns):
+    """Returns: The arrays to order the games of spec by, in turn"""
+    for x in spec["sort"]:
+        if x.lstrip("-") not in columns:
+            raise SpecError("List spec %s: no %s column in the rating data"
+                            % (spec["category"], x.lstrip("-")))
+    return tuple(-columns[x[1:]] if x.startswith("-") else columns[x]
+                 for x in spec["sort"])
+
+
+def rank_by(specs, ranking):
+    """Returns: specs ordering by the columns of ranking instead of mean"""
+    descending, ascending = RANKINGS[ranking]
+    if ranking == "mean":
+        return specs
+    ranked = list()
+    for spec in specs:
+        spec = dict(spec)
+        spec["sort"] = [
+            "-" + descending if x == "-mean" else ascending if x == "mean"
+            else x for x in spec["sort"]]
+        ranked.append(spec)
+    return ranked
+
+
+def info_filter(spec):
+    """Returns: A function telling from a game info whether the game may
+        be listed by the expansion policy and year bounds of spec, None
+        if the info lacks the year, e.g. one imported from game_infos.json
+    """
+    policy = spec.get("expansions", "exclude")
+    min_year = spec.get("min_year")
+    max_year = spec.get("max_year")
+
+    def accepts(info):
+        if policy != "include" and info["expansion"] != (policy == "only"):
+            return False
+        if min_year is None and max_year is None:
+            return True
+        if "year" not in info:
+            return None
+        year = info["year"]
+        if year is None:
+            return False
+        return ((min_year is None or year >= min_year)
+                and (max_year is None or year < max_year))
+    return accepts
@@ -0,0 +1,107 @@
+# Instrumentation of guild runs
+#
+# Wall times of the phases of a run, request and retry counters, bytes
+# received and latencies are collected by the module level Metrics of
+# the current run and written as a JSON report.
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class Metrics:
+    """Phase wall times, counters and latency samples, thread safe"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = dict()
+        self.counters = dict()
+        self.latencies = dict()
+
+    @contextmanager
+    def phase(self, name):
+        """Add the wall time of the with block to phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        """Count a call of name and sample its latency, failed calls are
+            counted as name_errors.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(name + "_errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            self.count(name)
+
+    def report(self):
+        """The metrics as a dict of plain numbers, latencies in seconds"""
+        with self.lock:
+            latencies = dict()
+            for name, samples in self.latencies.items():
+                samples = np.asarray(samples)
+                summary = {"count": len(samples),
+                           "mean": float(samples.mean()),
+                           "max": float(samples.max())}
+                for p, value in zip(PERCENTILES,
+                                    np.percentile(samples, PERCENTILES)):
+                    summary["p%d" % p] = float(value)
+                latencies[name] = summary
+            return {"wall_time": time.perf_counter() - self.started,
+                    "phases": dict(self.phases),
+                    "counters": dict(self.counters),
+                    "latencies": latencies}
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+current = Metrics()
+
+
+def reset():
+    """Start collecting the metrics of a new run"""
+    global current
+    current = Metrics()
+    return current
+
+
+def phase(name):
+    return current.phase(name)
+
+
+def count(name, n=1):
+    current.count(name, n)
+
+
+def observe(name, seconds):
+    current.observe(name, seconds)
+
+
+def timed(name):
+    return current.timed(name)
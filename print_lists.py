@@ -2,53 +2,104 @@ import argparse
 import datetime
 import gettext
 import json
+import sys
 
+from reporting import (CATEGORY_NAMES, game_name, load_translation,
+                       normalize_style, output_filename, run_batch,
+                       split_choices)
 
-def print_list(category, games, headline, count, style):
-    """Print list per category in given style to file."""
-    hlevel = "h3"
-    ths = [_("No."), _("Game"), _("Ratings"), _("Mean"), _("Stdev")]
+HLEVEL = "h3"
 
-    json_data = games
-    if style == "html":
-        print("<", hlevel, ">", headline, "</", hlevel, ">", sep="", file=of)
-        print("<table id=", category, "><thead><tr>", sep="", file=of)
-        for i, th in enumerate(ths):
-            print("<th>", th, "</th>", sep="", file=of)
-        print("</tr></thead><tbody>", sep="", file=of)
-        for idx, game in enumerate(json_data):
-            table_row_data = (idx + 1, game[0], game[2], game[3], game[4])
-            print("<tr><td class=\"text-right\">{:2}</td> \
+# Templates keep the whitespace of the reports published so far
+HTML_STYLE = "<style>\n.text-right {\
+                        text-align: right; padding: 0 5px;}\n\
+                    </style>\n"
+HTML_ROW = "<tr><td class=\"text-right\">{:2}</td> \
                 <td>{}</td><td class=\"text-right\">{:2}</td> \
                 <td class=\"text-right\">{:5.3f}</td> \
-                <td class=\"text-right\">{:5.3f}</td></tr>".format(
-                *table_row_data), file=of)
-        print("</tbody></table>", file=of)
+                <td class=\"text-right\">{:5.3f}</td></tr>\n"
+BBCODE_ROW = "[tr][td]{:2}[/td][td]{}[/td][td]{:2}[/td] \
+                [td]{:5.3f}[/td][td]{:5.3f}[/td][/tr]\n"
+BGG_ROW = "{:2} {:%d} {:3} {:5.3f} {:5.3f}\n"
+
+
+def table_headers(_):
+    return [_("No."), _("Game"), _("Ratings"), _("Mean"), _("Stdev")]
+
+
+def headline(entry, _):
+    """The translated headline of a list of the default categories, else
+        the title of its spec
+    """
+    category = entry["category"]
+    if category in CATEGORY_NAMES:
+        return _(CATEGORY_NAMES[category])
+    return entry.get("title", category)
+
+
+def render_list(category, games, headline, style, _):
+    """Render the list of one category in given style.
+        Returns: A list of strings
+    """
+    ths = table_headers(_)
+    rows = [(idx + 1, game_name(game), game[2], game[3], game[4])
+            for idx, game in enumerate(games)]
+    if style == "html":
+        parts = ["<", HLEVEL, ">", headline, "</", HLEVEL, ">\n",
+                 "<table id=", category, "><thead><tr>\n"]
+        parts.extend("<th>" + th + "</th>\n" for th in ths)
+        parts.append("</tr></thead><tbody>\n")
+        parts.extend(HTML_ROW.format(*row) for row in rows)
+        parts.append("</tbody></table>\n")
     elif style == "bbcode":
-        print("[", hlevel, "]", headline, "[/", hlevel, "]", sep="", file=of)
-        print("[table][tr]", sep="", file=of)
-        for i, th in enumerate(ths):
-            print("[th]", th, "[/th]", sep="", file=of)
-        print("[/tr]", sep="", file=of)
-        for idx, game in enumerate(json_data):
-            table_row_data = (idx + 1, game[0], game[2], game[3], game[4])
-            print("[tr][td]{:2}[/td][td]{}[/td][td]{:2}[/td] \
-                [td]{:5.3f}[/td][td]{:5.3f}[/td][/tr]".format(
-                *table_row_data), file=of)
-        print("[/table]", file=of)
+        parts = ["[", HLEVEL, "]", headline, "[/", HLEVEL, "]\n",
+                 "[table][tr]\n"]
+        parts.extend("[th]" + th + "[/th]\n" for th in ths)
+        parts.append("[/tr]\n")
+        parts.extend(BBCODE_ROW.format(*row) for row in rows)
+        parts.append("[/table]\n")
     else:
         # bgg-style
-        format_string_prefix = u"{:2} {:"
-        format_string_ext = u"} {:3} {:5.3f} {:5.3f}"
-        max_name_width = max([len(game[0]) for game in json_data])
-        format_string = format_string_prefix \
-            + str(max_name_width) + format_string_ext
-        print("\n[b]", headline, "[/b]\n[c]", sep="", file=of)
-        for idx, game in enumerate(json_data):
-            detail_string = format_string.format(
-                idx + 1, game[0], game[2], game[3], game[4])
-            print(detail_string, file=of)
-        print("[/c]", file=of)
+        row_template = BGG_ROW % max([len(row[1]) for row in rows],
+                                     default=0)
+        parts = ["\n[b]", headline, "[/b]\n[c]\n"]
+        parts.extend(row_template.format(*row) for row in rows)
+        parts.append("[/c]\n")
+    return parts
+
+
+def render(data, style, translation=None):
+    """Render all lists of data (a loaded lists_YYYYMMDD.json).
+        Returns: The report as string
+    """
+    if translation is None:
+        translation = gettext.NullTranslations()
+    _ = translation.gettext
+    parts = [HTML_STYLE] if style == "html" else []
+    for d in data["lists"]:
+        parts.extend(render_list(d["category"], d["games"],
+                                 headline(d, _), style, _))
+    return "".join(parts)
+
+
+def write_report(data, style, translation=None, out=None):
+    """Render data and write it in one go to out: a file name, a file
+        object or stdout if None
+    """
+    report = render(data, style, translation)
+    if out is None:
+        sys.stdout.write(report)
+    elif hasattr(out, "write"):
+        out.write(report)
+    else:
+        with open(out, "w") as of:
+            of.write(report)
+
+
+def render_file(data, style, lang, filename):
+    """Batch job: write data in style and lang to filename"""
+    write_report(data, style, load_translation("print_lists", lang),
+                 filename)
 
 
 if __name__ == "__main__":
@@ -61,41 +112,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "--style",
         default="html",
-        help="output format: bbcode|bgg|html - default: html")
+        help="output format: bbcode|bgg|html, several separated by "
+             "commas - default: html")
     parser.add_argument(
         "--lang",
         default="en",
-        help="language used for headlines and tableheaders")
+        help="language used for headlines and tableheaders, several "
+             "separated by commas")
+    parser.add_argument(
+        "--stdout",
+        action="store_true",
+        help="write to stdout instead of output_YYYYMMDD.html/txt")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="render in JOBS processes, default=1")
     args = parser.parse_args()
 
-    lang = gettext.translation("print_lists", localedir="locales",
-                               languages=[args.lang])
-    lang.install()
-    _ = lang.gettext
-
     with open(args.filename) as f:
         data = json.load(f)
-        f.close()
+    styles = [normalize_style(x) for x in split_choices(args.style)]
+    langs = split_choices(args.lang)
+    if args.stdout:
+        for lang in langs:
+            for style in styles:
+                write_report(data, style,
+                             load_translation("print_lists", lang))
+    else:
+        # several outputs are told apart by output_YYYYMMDD_lang_style
         date_str = datetime.datetime.now().strftime("%Y%m%d")
-        if (args.style == "bgg") or (args.style == "bbcode"):
-            style = args.style
-            ext = "txt"
-        else:
-            style = "html"
-            ext = "html"
-
-        with open("output_" + date_str + "." + ext, "w") as of:
-            headlines = [
-                _("Top"), _("Bottom"),
-                _("Most Varied"), _("Most Similar"),
-                _("Most Rated"), _("Sleepers")]
-            if style == "html":
-                print("<style>\n.text-right {\
-                        text-align: right; padding: 0 5px;}\n\
-                    </style>", file=of)
-            i = 0
-            for d in data["lists"]:
-                print_list(d["category"], d["games"],
-                           headlines[i], d["count"], style)
-                i += 1
-            of.close()
+        batch = len(styles) * len(langs) > 1
+        jobs = [(data, style, lang,
+                 output_filename("output", date_str, style,
+                                 lang if batch else None))
+                for lang in langs for style in styles]
+        run_batch(render_file, jobs, args.jobs)
@@ -0,0 +1,279 @@
+# Rating statistics for all games of a guild
+#
+# The ratings of all members are flattened into NumPy arrays once, count,
+# mean and sample standard deviation of every game are then computed in
+# one vectorized pass instead of per game with the statistics module.
+# RatingAccumulator computes the same statistics folding in one member
+# at a time, holding memory per game instead of per rating.
+#
+# Alternative ranking values for the lists: means shrunk towards the
+# guild mean (Bayesian average), confidence bounds of the means and
+# means of the ratings z-scored per member, which evens out members
+# rating on different parts of the scale.
+
+from statistics import mean, stdev
+
+import numpy as np
+
+DEFAULT_PRIOR_WEIGHT = 10
+# two-sided 95% of the normal distribution
+DEFAULT_CONFIDENCE_Z = 1.96
+
+
+def rating_arrays(member_ratings):
+    """Flatten a dict member -> dict gameid -> rating.
+        Returns: Arrays (game ids, ratings) in the order of the dicts
+    """
+    total = sum(len(x) for x in member_ratings.values())
+    game_ids = np.fromiter(
+        (game for ratings in member_ratings.values() for game in ratings),
+        dtype=np.int64, count=total)
+    ratings = np.fromiter(
+        (rating for ratings in member_ratings.values()
+         for rating in ratings.values()),
+        dtype=np.float64, count=total)
+    return game_ids, ratings
+
+
+def game_statistics(game_ids, ratings):
+    """Count, mean and sample standard deviation per game.
+        Returns: Arrays (game ids, counts, means, sds), games ordered by
+        their first rating; sd is 0 for games with a single rating
+    """
+    games, first, inverse = np.unique(
+        game_ids, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse)
+    means = np.bincount(inverse, weights=ratings) / counts
+    deviations = ratings - means[inverse]
+    squares = np.bincount(inverse, weights=deviations * deviations)
+    sds = np.zeros(len(games))
+    multiple = counts > 1
+    sds[multiple] = np.sqrt(squares[multiple] / (counts[multiple] - 1))
+    exact_statistics(inverse, ratings, means, sds)
+    order = np.argsort(first, kind="stable")
+    return games[order], counts[order], means[order], sds[order]
+
+
+def near_boundary(means, sds, tolerance=1e-6):
+    """Mask of the games whose mean or sd is close to a rounding boundary
+        at 3 decimals, their rounding may depend on the summation order
+    """
+    ambiguous = np.zeros(len(means), dtype=bool)
+    for values in (means, sds):
+        ambiguous |= np.abs(values * 1000 % 1 - 0.5) < tolerance
+    return ambiguous
+
+
+def exact_statistics(inverse, ratings, means, sds):
+    """Recompute means and sds close to a rounding boundary at 3 decimals
+        with the exact statistics module, so rounded results never depend
+        on the summation order
+    """
+    ambiguous = near_boundary(means, sds)
+    if not ambiguous.any():
+        return
+    mask = ambiguous[inverse]
+    subset = inverse[mask]
+    order = np.argsort(subset, kind="stable")
+    groups, starts = np.unique(subset[order], return_index=True)
+    for group, values in zip(groups, np.split(ratings[mask][order],
+                                              starts[1:])):
+        values = values.tolist()
+        means[group] = mean(values)
+        if len(values) > 1:
+            sds[group] = stdev(values)
+
+
+def rounded_statistics(games, counts, means, sds):
+    """Returns: A list of (game_id, num_ratings, avg_rating, sd_ratings)
+        rounded to 3 decimals
+    """
+    return [(game_id, num_ratings, round(avg_rating, 3),
+             round(sd_ratings, 3) if num_ratings > 1 else 0)
+            for game_id, num_ratings, avg_rating, sd_ratings
+            in zip(games.tolist(), counts.tolist(),
+                   means.tolist(), sds.tolist())]
+
+
+def aggregate_ratings(member_ratings):
+    """Returns: A list of (game_id, num_ratings, avg_rating, sd_ratings)
+        rounded to 3 decimals, games ordered by their first rating
+    """
+    return rounded_statistics(
+        *game_statistics(*rating_arrays(member_ratings)))
+
+
+def member_z_scores(ratings):
+    """z-scores of one member's ratings array, 0 if all are equal"""
+    deviations = ratings - ratings.mean()
+    sd = np.sqrt(np.mean(deviations * deviations))
+    if sd == 0:
+        return np.zeros(len(ratings))
+    return deviations / sd
+
+
+def normalized_means(member_ratings):
+    """Mean per game of the ratings z-scored per member.
+        Returns: A dict gameid -> mean z-score
+    """
+    sizes = np.fromiter(map(len, member_ratings.values()), dtype=np.int64,
+                        count=len(member_ratings))
+    game_ids, ratings = rating_arrays(member_ratings)
+    if len(ratings) == 0:
+        return dict()
+    member = np.repeat(np.arange(len(sizes)), sizes)
+    rated = np.maximum(sizes, 1)
+    deviations = ratings - (np.bincount(member, weights=ratings,
+                                        minlength=len(sizes)) / rated)[member]
+    sds = np.sqrt(np.bincount(member, weights=deviations * deviations,
+                              minlength=len(sizes)) / rated)[member]
+    scores = np.zeros(len(ratings))
+    np.divide(deviations, sds, out=scores, where=sds > 0)
+    games, inverse = np.unique(game_ids, return_inverse=True)
+    means = np.bincount(inverse, weights=scores) / np.bincount(inverse)
+    return dict(zip(games.tolist(), means.tolist()))
+
+
+def bayesian_means(counts, means, prior_weight=DEFAULT_PRIOR_WEIGHT,
+                   prior_mean=None):
+    """Means shrunk towards prior_mean as if every game had prior_weight
+        more ratings of it, by default the mean of all ratings
+    """
+    if prior_mean is None:
+        total = counts.sum()
+        prior_mean = (counts * means).sum() / total if total else 0
+    return (prior_weight * prior_mean + counts * means) / (
+        prior_weight + counts)
+
+
+def confidence_bounds(counts, means, sds, z=DEFAULT_CONFIDENCE_Z):
+    """Normal approximation bounds of the means, games with a single
+        rating get the pooled sd of all games.
+        Returns: Arrays (lower, upper)
+    """
+    multiple = counts > 1
+    freedom = (counts[multiple] - 1).sum()
+    pooled = 0
+    if freedom:
+        pooled = np.sqrt(((counts[multiple] - 1) * sds[multiple] ** 2).sum()
+                         / freedom)
+    margins = z * np.where(multiple, sds, pooled) / np.sqrt(
+        np.maximum(counts, 1))
+    return means - margins, means + margins
+
+
+class RatingAccumulator:
+    """Count, running mean and sum of squared deviations (Welford) per
+        game of the member ratings added so far, and the sum of their
+        z-scores. Members may be added in any order, games are ordered by
+        their first rating in the order of the members' ranks like in
+        aggregate_ratings.
+    """
+
+    def __init__(self, capacity=1024):
+        self.slots = dict()
+        self.game_ids = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.means = np.zeros(capacity)
+        self.squares = np.zeros(capacity)
+        self.scores = np.zeros(capacity)
+        self.first_rank = np.full(capacity, np.iinfo(np.int64).max)
+        self.first_position = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def grow(self, size):
+        capacity = max(size, 2 * len(self.counts))
+        for name in ("game_ids", "counts", "means", "squares", "scores",
+                     "first_rank", "first_position"):
+            array = getattr(self, name)
+            grown = np.resize(array, capacity)
+            if name == "first_rank":
+                grown[len(array):] = np.iinfo(np.int64).max
+            else:
+                grown[len(array):] = 0
+            setattr(self, name, grown)
+
+    def add(self, ratings, rank):
+        """Fold in a dict gameid -> rating of the member with rank"""
+        size = len(ratings)
+        if size == 0:
+            return
+        slots = self.slots
+        index = np.fromiter(
+            (slots.setdefault(game, len(slots)) for game in ratings),
+            dtype=np.int64, count=size)
+        if len(slots) > len(self.counts):
+            self.grow(len(slots))
+        values = np.fromiter(ratings.values(), dtype=np.float64, count=size)
+        self.game_ids[index] = np.fromiter(ratings, dtype=np.int64,
+                                           count=size)
+        first = rank < self.first_rank[index]
+        self.first_rank[index[first]] = rank
+        self.first_position[index[first]] = np.flatnonzero(first)
+
+        counts = self.counts[index] + 1
+        delta = values - self.means[index]
+        means = self.means[index] + delta / counts
+        self.squares[index] += delta * (values - means)
+        self.means[index] = means
+        self.counts[index] = counts
+        self.scores[index] += member_z_scores(values)
+
+    def normalized_means(self):
+        """Returns: A dict gameid -> mean z-score like normalized_means"""
+        size = len(self.slots)
+        return dict(zip(self.game_ids[:size].tolist(),
+                        (self.scores[:size] / self.counts[:size]).tolist()))
+
+    def statistics(self):
+        """Returns: Arrays (game ids, counts, means, sds) like
+            game_statistics, before the exact recomputation
+        """
+        size = len(self.slots)
+        order = np.lexsort((self.first_position[:size],
+                            self.first_rank[:size]))
+        counts = self.counts[order]
+        sds = np.zeros(size)
+        multiple = counts > 1
+        sds[multiple] = np.sqrt(self.squares[order][multiple]
+                                / (counts[multiple] - 1))
+        return self.game_ids[order], counts, self.means[order], sds
+
+    def aggregate(self, spill=None):
+        """The result of aggregate_ratings for the members added. spill
+            yields the members' rating dicts again, e.g. from a
+            checkpoint, to recompute statistics close to a rounding
+            boundary exactly; without it those may differ in the last
+            digit.
+        """
+        games, counts, means, sds = self.statistics()
+        ambiguous = np.flatnonzero(near_boundary(means, sds))
+        if spill is not None and len(ambiguous):
+            wanted = {game: list() for game in games[ambiguous].tolist()}
+            for ratings in spill:
+                for game in wanted.keys() & ratings.keys():
+                    wanted[game].append(ratings[game])
+            for i, values in zip(ambiguous, wanted.values()):
+                means[i] = mean(values)
+                if len(values) > 1:
+                    sds[i] = stdev(values)
+        return rounded_statistics(games, counts, means, sds)
+
+
+def select_smallest(keys, accept, size):
+    """Indices of the size accepted entries with the smallest keys.
+        keys: arrays compared in turn, ties keep the order of the entries;
+        accept: boolean array. Only the entries up to the size-th
+        smallest first key get sorted.
+        Returns: An index array ordered by keys
+    """
+    candidates = np.flatnonzero(accept)
+    primary = keys[0][candidates]
+    if len(candidates) > size > 0:
+        kth = np.partition(primary, size - 1)[size - 1]
+        candidates = candidates[primary <= kth]
+    order = np.lexsort(
+        [candidates] + [key[candidates] for key in reversed(keys)])
+    return candidates[order][:size]
@@ -0,0 +1,369 @@
+# Recommendations from the ratings of similar guild members
+#
+# build computes once per snapshot the k most similar members of every
+# member (neighbour index) and the k most similar games of every game
+# rated often enough (adjusted cosine over co-ratings), in several
+# processes, and saves them as .npz. Queries are then answered from the
+# index and the memory-mapped snapshot without comparing members again:
+# games a member has not rated are scored by their neighbours' ratings,
+# relative to each neighbour's mean and weighted by similarity.
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+
+import game_cache
+from similarity import ASCENDING, METRICS, load_rating_matrix
+
+DEFAULT_NEIGHBOURS = 20
+DEFAULT_MIN_COMMON = 10
+DEFAULT_MIN_RATERS = 10
+CHUNK_SIZE = 256
+
+# Rating matrix of a build worker, loaded once per process, and its
+# centered ratings of the games with enough raters
+matrix = None
+items = None
+
+
+def load_worker(member_data_file):
+    global matrix, items
+    matrix = load_rating_matrix(member_data_file)
+    items = None
+
+
+def smallest_per_row(keys, k):
+    """Column indices of the k smallest keys of every row, ordered by key
+        and index, -1 where the key is not finite
+    """
+    k = min(k, keys.shape[1])
+    if k < keys.shape[1]:
+        top = np.argpartition(keys, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(keys.shape[1]), (len(keys), 1))
+    top_keys = np.take_along_axis(keys, top, axis=1)
+    order = np.lexsort((top, top_keys), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top[~np.isfinite(np.take_along_axis(top_keys, order, axis=1))] = -1
+    return top
+
+
+def member_means(rating_matrix):
+    """Returns: The mean rating of every member, 0 without ratings"""
+    counts = np.diff(rating_matrix.indptr)
+    sums = np.bincount(rating_matrix.rows, weights=rating_matrix.ratings,
+                       minlength=len(counts))
+    return np.divide(sums, counts, out=np.zeros(len(counts)),
+                     where=counts > 0)
+
+
+def neighbour_chunk(start, stop, k, metric, min_common):
+    """Build worker: the k nearest neighbours of members start to stop.
+        Returns: (start, neighbours, similarities, weights, common)
+    """
+    members = np.arange(start, stop)
+    result = matrix.compare_rows(members)
+    values = result[metric]
+    common = result["common"]
+    keys = values if metric in ASCENDING else -values
+    keys = np.where(np.isnan(keys) | (common < min_common), np.inf, keys)
+    keys[np.arange(len(members)), members] = np.inf
+    neighbours = smallest_per_row(keys, k)
+    valid = neighbours >= 0
+    picked = np.where(valid, neighbours, 0)
+    if metric in ASCENDING:
+        # msd of 0 is the most similar, weights in (0, 1]
+        weights = 1 / (1 + np.take_along_axis(result["msd"], picked, 1))
+    else:
+        weights = np.maximum(np.take_along_axis(values, picked, 1), 0)
+    return (start, neighbours,
+            np.where(valid, np.take_along_axis(values, picked, 1), np.nan),
+            np.where(valid, weights, 0),
+            np.where(valid, np.take_along_axis(common, picked, 1), 0))
+
+
+def rated_columns(rating_matrix, min_raters):
+    """Returns: The indices of the games rated by at least min_raters
+        members
+    """
+    raters = np.bincount(rating_matrix.game_index,
+                         minlength=len(rating_matrix.games))
+    return np.flatnonzero(raters >= min_raters)
+
+
+def centered_columns(rating_matrix, min_raters):
+    """Members x games dense ratings minus each member's mean of the
+        games rated by at least min_raters members.
+        Returns: (game column indices, centered ratings, rated)
+    """
+    columns = rated_columns(rating_matrix, min_raters)
+    position = np.full(len(rating_matrix.games), -1)
+    position[columns] = np.arange(len(columns))
+    entries = position[rating_matrix.game_index] >= 0
+    rows = rating_matrix.rows[entries]
+    cols = position[rating_matrix.game_index[entries]]
+    centered = np.zeros((len(rating_matrix.members), len(columns)))
+    centered[rows, cols] = (rating_matrix.ratings[entries]
+                            - member_means(rating_matrix)[rows])
+    # counts of common raters stay exact in float32
+    rated = np.zeros(centered.shape, dtype=np.float32)
+    rated[rows, cols] = 1
+    return columns, centered, rated
+
+
+def item_chunk(start, stop, k, min_raters, min_common):
+    """Build worker: the k most similar games of the games start to stop
+        among those rated by at least min_raters members.
+        Returns: (start, neighbours, similarities, common)
+    """
+    global items
+    if items is None:
+        items = centered_columns(matrix, min_raters)
+    _, centered, rated = items
+    norms = np.sqrt((centered * centered).sum(axis=0))
+    products = centered[:, start:stop].T @ centered
+    common = rated[:, start:stop].T @ rated
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarities = products / np.outer(norms[start:stop], norms)
+    keys = np.where(np.isnan(similarities) | (common < min_common),
+                    np.inf, -similarities)
+    keys[np.arange(stop - start), np.arange(start, stop)] = np.inf
+    neighbours = smallest_per_row(keys, k)
+    valid = neighbours >= 0
+    picked = np.where(valid, neighbours, 0)
+    return (start, neighbours,
+            np.where(valid, np.take_along_axis(similarities, picked, 1),
+                     np.nan),
+            np.where(valid, np.take_along_axis(common, picked, 1), 0))
+
+
+def build_index(member_data_file, filename, k=DEFAULT_NEIGHBOURS,
+                metric="pearson", min_common=DEFAULT_MIN_COMMON,
+                min_raters=DEFAULT_MIN_RATERS, jobs=1):
+    """Compute the neighbour and game similarity index of the members in
+        member_data_file in chunks, in jobs processes if more than one,
+        and save it to filename (.npz).
+    """
+    load_worker(member_data_file)
+    size = len(matrix.members)
+    item_games = rated_columns(matrix, min_raters)
+    tasks = [(neighbour_chunk, start, min(start + CHUNK_SIZE, size), k,
+              metric, min_common)
+             for start in range(0, size, CHUNK_SIZE)]
+    tasks += [(item_chunk, start, min(start + CHUNK_SIZE, len(item_games)),
+               k, min_raters, min_common)
+              for start in range(0, len(item_games), CHUNK_SIZE)]
+
+    index = {
+        "neighbours": np.full((size, k), -1, dtype=np.int32),
+        "similarity": np.full((size, k), np.nan),
+        "weight": np.zeros((size, k)),
+        "common": np.zeros((size, k), dtype=np.int32),
+        "item_neighbours": np.full((len(item_games), k), -1, dtype=np.int32),
+        "item_similarity": np.full((len(item_games), k), np.nan),
+        "item_common": np.zeros((len(item_games), k), dtype=np.int32)}
+
+    def store(task, result):
+        start, *arrays = result
+        names = (("neighbours", "similarity", "weight", "common")
+                 if task[0] is neighbour_chunk else
+                 ("item_neighbours", "item_similarity", "item_common"))
+        for name, array in zip(names, arrays):
+            index[name][start:start + len(array), :array.shape[1]] = array
+
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=load_worker,
+                                 initargs=(member_data_file,)) as executor:
+            futures = [(task, executor.submit(*task)) for task in tasks]
+            for task, future in futures:
+                store(task, future.result())
+    else:
+        for task in tasks:
+            store(task, task[0](*task[1:]))
+
+    np.savez(filename, members=np.array(matrix.members),
+             games=matrix.games, means=member_means(matrix),
+             item_games=matrix.games[item_games],
+             source=np.array(os.path.abspath(member_data_file)),
+             metric=np.array(metric), **index)
+
+
+class RecommendationIndex:
+    """Index saved by build_index with the rating matrix it was built
+        from, memory-mapped for snapshots
+    """
+
+    def __init__(self, filename, member_data_file=None):
+        with np.load(filename) as data:
+            self.index = {name: data[name] for name in data.files}
+        self.members = self.index["members"].tolist()
+        self.member_index = {x: i for i, x in enumerate(self.members)}
+        self.item_index = {x: i for i, x in enumerate(
+            self.index["item_games"].tolist())}
+        self.matrix = load_rating_matrix(
+            member_data_file or str(self.index["source"]))
+        if self.matrix.members != self.members:
+            raise ValueError("The index was built from other member data")
+
+    def neighbours(self, member):
+        """Returns: A list of (member, similarity, common games)"""
+        i = self.member_index[member]
+        return [(self.members[j], float(similarity), int(common))
+                for j, similarity, common in zip(
+                    self.index["neighbours"][i], self.index["similarity"][i],
+                    self.index["common"][i])
+                if j >= 0]
+
+    def recommend(self, member, count=20, min_support=3):
+        """Games member has not rated, predicted from the neighbours'
+            ratings relative to their means, rated by at least
+            min_support neighbours.
+            Returns: A list of (gameid, predicted rating, neighbours who
+            rated it), best first
+        """
+        i = self.member_index[member]
+        valid = self.index["neighbours"][i] >= 0
+        neighbours = self.index["neighbours"][i][valid]
+        weights = self.index["weight"][i][valid]
+        indptr = self.matrix.indptr
+        games = np.concatenate(
+            [self.matrix.game_index[indptr[j]:indptr[j + 1]]
+             for j in neighbours] + [np.zeros(0, dtype=np.int64)])
+        deviations = np.concatenate(
+            [self.matrix.ratings[indptr[j]:indptr[j + 1]]
+             - self.index["means"][j] for j in neighbours] + [np.zeros(0)])
+        rater_weights = np.repeat(weights, np.diff(indptr)[neighbours])
+        size = len(self.matrix.games)
+        support = np.bincount(games, minlength=size)
+        total_weight = np.bincount(games, weights=rater_weights,
+                                   minlength=size)
+        scores = np.bincount(games, weights=rater_weights * deviations,
+                             minlength=size)
+        candidates = (support >= min_support) & (total_weight > 0)
+        candidates[self.matrix.game_index[indptr[i]:indptr[i + 1]]] = False
+        candidates = np.flatnonzero(candidates)
+        predicted = (self.index["means"][i]
+                     + scores[candidates] / total_weight[candidates])
+        order = np.lexsort((-support[candidates], -predicted))[:count]
+        return [(int(self.matrix.games[g]), float(p), int(n))
+                for g, p, n in zip(candidates[order], predicted[order],
+                                   support[candidates][order])]
+
+    def similar_games(self, game_id, count=20):
+        """Returns: A list of (gameid, similarity, common raters) of the
+            games rated most alike game_id, empty if it is rated too
+            rarely
+        """
+        g = self.item_index.get(game_id)
+        if g is None:
+            return []
+        item_games = self.index["item_games"]
+        return [(int(item_games[j]), float(similarity), int(common))
+                for j, similarity, common in zip(
+                    self.index["item_neighbours"][g][:count],
+                    self.index["item_similarity"][g][:count],
+                    self.index["item_common"][g][:count])
+                if j >= 0]
+
+
+def game_names(game_ids, cache):
+    """Returns: A dict gameid -> name of the games in the game info
+        cache, if there is one
+    """
+    if not os.path.exists(cache):
+        return dict()
+    infos = game_cache.GameInfoCache(cache, legacy=None)
+    names = dict()
+    for game_id in game_ids:
+        info = infos.get(game_id)
+        if info is not None:
+            names[game_id] = info["name"]
+    infos.close()
+    return names
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Recommend games by the ratings of similar members")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser(
+        "build", help="build the index of a member data file")
+    build.add_argument(
+        "member_data", help="member_data_YYYYMMDD.snap, .jsonl or .yml")
+    build.add_argument(
+        "-o", "--output",
+        help="index file, default: MEMBER_DATA with _recommend.npz")
+    build.add_argument(
+        "-k", type=int, default=DEFAULT_NEIGHBOURS,
+        help="neighbours kept per member and game, default=%d"
+             % DEFAULT_NEIGHBOURS)
+    build.add_argument(
+        "--metric", choices=METRICS, default="pearson",
+        help="similarity of members, default: pearson")
+    build.add_argument(
+        "--min-common", type=int, default=DEFAULT_MIN_COMMON,
+        help="games rated in common by neighbours, raters in common by "
+             "similar games, default=%d" % DEFAULT_MIN_COMMON)
+    build.add_argument(
+        "--min-raters", type=int, default=DEFAULT_MIN_RATERS,
+        help="only index games with MIN_RATERS ratings for similar games, "
+             "default=%d" % DEFAULT_MIN_RATERS)
+    build.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="build in JOBS processes, default: one per core")
+    for name, help_text in (
+            ("query", "recommend games to a member"),
+            ("neighbours", "list the most similar members of a member"),
+            ("similar", "list the games rated most alike a game")):
+        query = subparsers.add_parser(name, help=help_text)
+        query.add_argument("index", help="index file written by build")
+        if name == "similar":
+            query.add_argument("--game", type=int, required=True)
+        else:
+            query.add_argument("--user", required=True)
+        query.add_argument(
+            "-n", type=int, default=20,
+            help="number of results, default=20")
+        query.add_argument(
+            "--member-data",
+            help="member data the index was built from, if moved")
+        query.add_argument(
+            "--cache", default=game_cache.DEFAULT_FILENAME,
+            help="game info cache for the names, default="
+                 + game_cache.DEFAULT_FILENAME)
+        if name == "query":
+            query.add_argument(
+                "--min-support", type=int, default=3,
+                help="neighbours who rated a recommended game, default=3")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        output = args.output or (
+            os.path.splitext(args.member_data)[0] + "_recommend.npz")
+        start = time.perf_counter()
+        build_index(args.member_data, output, args.k, args.metric,
+                    args.min_common, args.min_raters, args.jobs)
+        print("Wrote", output, "in %.1f s" % (time.perf_counter() - start))
+    else:
+        index = RecommendationIndex(args.index, args.member_data)
+        if args.command == "neighbours":
+            if args.user not in index.member_index:
+                parser.error("unknown member " + args.user)
+            for member, similarity, common in index.neighbours(
+                    args.user)[:args.n]:
+                print("%-24s %7.3f %5d" % (member, similarity, common))
+        else:
+            if args.command == "query":
+                if args.user not in index.member_index:
+                    parser.error("unknown member " + args.user)
+                rows = index.recommend(args.user, args.n, args.min_support)
+            else:
+                rows = index.similar_games(args.game, args.n)
+            names = game_names([row[0] for row in rows], args.cache)
+            for game_id, value, support in rows:
+                print("%-40s %7.3f %5d" % (
+                    names.get(game_id, str(game_id)), value, support))
@@ -0,0 +1,65 @@
+# Helpers shared by print_lists.py and diff_toplists.py
+#
+# Both scripts can render several styles and languages in one run,
+# loading the input once and every translation catalog only once.
+
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import gettext
+
+STYLES = ("html", "bbcode", "bgg")
+
+
+def N_(message):
+    """Mark message for translation, it is translated when rendered"""
+    return message
+
+
+# Headlines of the default list categories
+CATEGORY_NAMES = {
+    "top": N_("Top"), "bottom": N_("Bottom"),
+    "variance": N_("Most Varied"), "similar": N_("Most Similar"),
+    "most_rated": N_("Most Rated"), "sleepers": N_("Sleepers")}
+
+
+@functools.lru_cache(maxsize=None)
+def load_translation(domain, lang, localedir="locales"):
+    """Returns: The gettext catalog of domain for lang, parsed only once"""
+    return gettext.translation(domain, localedir=localedir, languages=[lang])
+
+
+def split_choices(value):
+    """Split a comma separated option value like "html,bbcode" """
+    return [x.strip() for x in value.split(",") if x.strip()]
+
+
+def normalize_style(style):
+    """Unknown styles fall back to html"""
+    return style if style in STYLES else "html"
+
+
+def game_name(game):
+    """The name of a listed game, its id if BGG knows no name"""
+    return str(game[1]) if game[0] is None else game[0]
+
+
+def output_extension(style):
+    return "html" if style == "html" else "txt"
+
+
+def output_filename(prefix, date_str, style, lang=None):
+    """prefix_YYYYMMDD.ext, with _lang_style appended if lang is given"""
+    suffix = "" if lang is None else "_" + lang + "_" + style
+    return prefix + "_" + date_str + suffix + "." + output_extension(style)
+
+
+def run_batch(task, jobs, workers=1):
+    """Call task(*args) for each args in jobs, in workers processes if
+        more than one. task has to be a module level function.
+        Returns: The results of the calls in the order of jobs
+    """
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [future.result() for future
+                    in [executor.submit(task, *args) for args in jobs]]
+    return [task(*args) for args in jobs]
@@ -0,0 +1,166 @@
+# Retries of failed BGG requests
+#
+# One RetryScheduler per run decides by the class of the error whether
+# and when a request is tried again: exponential backoff with jitter,
+# at most a budget of retries in total. Scheduled retries are picked up
+# before fresh work as soon as they are due instead of at the end.
+
+from collections import deque
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from bgg_api import (BGGApiError, BGGNotFoundError, BGGOfflineError,
+                     BGGQueuedError, BGGRateLimitError, BGGServerError)
+import metrics
+
+
+class RetryPolicy:
+    """Retry up to attempts times, waiting between half and all of
+        base * 2 ** retry seconds, at most cap. pause holds back all
+        requests during the wait.
+    """
+
+    def __init__(self, name, attempts, base=1, cap=60, pause=False):
+        self.name = name
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.pause = pause
+
+    def delay(self, retry, rnd):
+        delay = min(self.cap, self.base * 2 ** retry)
+        return delay / 2 + rnd.uniform(0, delay / 2)
+
+
+DEFAULT_BUDGET = 1000
+
+# First matching error class wins
+DEFAULT_POLICIES = (
+    (BGGNotFoundError, RetryPolicy("not_found", 0)),
+    (BGGOfflineError, RetryPolicy("offline", 0)),
+    (BGGQueuedError, RetryPolicy("queued", 6, base=2, cap=30)),
+    (BGGRateLimitError, RetryPolicy("rate_limit", 5, base=5, cap=120,
+                                    pause=True)),
+    (BGGServerError, RetryPolicy("server", 4, base=2, cap=60)),
+    (BGGApiError, RetryPolicy("error", 3, base=1, cap=30)),
+    (Exception, RetryPolicy("error", 1, base=1, cap=30)),
+)
+
+
+class RetryScheduler:
+    """Retries failed calls by the policy of their error class, at most
+        budget retries in total (None for no limit).
+    """
+
+    def __init__(self, policies=DEFAULT_POLICIES, budget=None, seed=None):
+        self.policies = policies
+        self.budget = budget
+        self.retries = 0
+        self.random = random.Random(seed)
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def policy(self, error):
+        for error_class, policy in self.policies:
+            if isinstance(error, error_class):
+                return policy
+        return None
+
+    def backoff(self, error, retry):
+        """Seconds to wait before retry number retry + 1 after error,
+            None to give up
+        """
+        policy = self.policy(error)
+        if policy is None or retry >= policy.attempts:
+            return None
+        with self.lock:
+            if self.budget is not None and self.retries >= self.budget:
+                metrics.count("retry_budget_exhausted")
+                return None
+            self.retries += 1
+            delay = policy.delay(retry, self.random)
+            retry_after = getattr(error, "retry_after", None)
+            if retry_after:
+                delay = max(delay, retry_after)
+            if policy.pause:
+                self.paused_until = max(self.paused_until,
+                                        time.monotonic() + delay)
+        metrics.count("retries_" + policy.name)
+        return delay
+
+    def wait_for_pause(self):
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+
+    def call(self, func, *args):
+        """Call func until it succeeds or its error is not retried,
+            which is raised then.
+        """
+        retry = 0
+        while True:
+            self.wait_for_pause()
+            try:
+                return func(*args)
+            except Exception as error:
+                delay = self.backoff(error, retry)
+                if delay is None:
+                    raise
+                print("Trying again in %.1f seconds after: %s"
+                      % (delay, error))
+                time.sleep(delay)
+                retry += 1
+
+    def run(self, func, items, workers=1):
+        """Call func for every item with workers threads. Failed items
+            are retried after their backoff, ahead of fresh items.
+            Yields: (item, result, None) or (item, None, error) for items
+            given up on, in the order they complete
+        """
+        from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                        wait)
+        fresh = deque(items)
+        delayed = list()
+        running = dict()
+        order = itertools.count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while fresh or delayed or running:
+                now = time.monotonic()
+                while len(running) < workers and now >= self.paused_until:
+                    if delayed and delayed[0][0] <= now:
+                        _, _, item, retry = heapq.heappop(delayed)
+                    elif fresh:
+                        item, retry = fresh.popleft(), 0
+                    else:
+                        break
+                    running[executor.submit(func, item)] = (item, retry)
+                # Wake up for the next due retry unless all workers are busy
+                waits = list()
+                if len(running) < workers:
+                    if delayed:
+                        waits.append(max(delayed[0][0], self.paused_until))
+                    if fresh:
+                        waits.append(self.paused_until)
+                timeout = max(0, min(waits) - now) if waits else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, retry = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        delay = self.backoff(error, retry)
+                        if delay is None:
+                            yield item, None, error
+                        else:
+                            heapq.heappush(delayed, (
+                                time.monotonic() + delay, next(order),
+                                item, retry + 1))
+                        continue
+                    yield item, result, None
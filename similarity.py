@@ -0,0 +1,198 @@
+# Similarity of members' ratings computed on the whole rating matrix
+#
+# All metrics only look at the games both members rated:
+#   score: sum of squared rating differences (lower is more similar)
+#   msd: mean squared difference, score / common
+#   pearson, cosine: correlation and cosine of both rating vectors
+
+import numpy as np
+
+from snapshot import MemberSnapshot, load_member_data, rating_rows
+
+METRICS = ("score", "msd", "pearson", "cosine")
+# metrics for which a lower value means more similar
+ASCENDING = ("score", "msd")
+
+
+def metrics(n, sx, sy, sxx, syy, sxy):
+    """Derive all metrics from the sums over common games.
+        Returns: A dict name -> array, including the common game counts
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = np.maximum(sxx + syy - 2 * sxy, 0)
+        variances = (n * sxx - sx * sx) * (n * syy - sy * sy)
+        norms = sxx * syy
+        return {
+            "common": n.astype(np.int64),
+            "score": score,
+            "msd": np.where(n > 0, score / n, np.nan),
+            "pearson": np.where(variances > 0,
+                                (n * sxy - sx * sy) / np.sqrt(variances),
+                                np.nan),
+            "cosine": np.where(norms > 0, sxy / np.sqrt(norms), np.nan)}
+
+
+class RatingMatrix:
+    """Members x games ratings in compressed sparse rows"""
+
+    def __init__(self, members, games, indptr, game_index, ratings):
+        self.members = list(members)
+        self.member_index = {x: i for i, x in enumerate(self.members)}
+        self.games = np.asarray(games)
+        self.indptr = np.asarray(indptr)
+        self.game_index = np.asarray(game_index, dtype=np.int64)
+        self.ratings = np.asarray(ratings, dtype=np.float64)
+        self.rows = np.repeat(np.arange(len(self.members)),
+                              np.diff(self.indptr))
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        if isinstance(snapshot, str):
+            snapshot = MemberSnapshot(snapshot)
+        return cls(snapshot.members, snapshot.games, snapshot.indptr,
+                   snapshot.game_index, snapshot.rating_values())
+
+    @classmethod
+    def from_dict(cls, member_ratings):
+        return cls(*rating_rows(member_ratings))
+
+    def compare(self, member):
+        """Compare member with every member in a single pass over all
+            ratings.
+            Returns: A dict metric -> array over members
+        """
+        i = self.member_index[member]
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        own = np.full(len(self.games), np.nan)
+        own[self.game_index[start:stop]] = self.ratings[start:stop]
+        x = own[self.game_index]
+        common = ~np.isnan(x)
+        x = x[common]
+        y = self.ratings[common]
+        rows = self.rows[common]
+        size = len(self.members)
+
+        def total(weights=None):
+            return np.bincount(rows, weights=weights, minlength=size)
+
+        result = metrics(total(), total(x), total(y),
+                         total(x * x), total(y * y), total(x * y))
+        # exact sums of squared differences instead of sxx + syy - 2 sxy
+        result["score"] = total((x - y) ** 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result["msd"] = np.where(result["common"] > 0,
+                                     result["score"] / result["common"],
+                                     np.nan)
+        return result
+
+    def shared_columns(self, min_raters=2):
+        """The ratings of games rated by at least min_raters members,
+            ordered by game.
+            Returns: (column per rating, member row per rating, ratings,
+            number of columns)
+        """
+        raters = np.bincount(self.game_index, minlength=len(self.games))
+        shared = raters[self.game_index] >= min_raters
+        columns = np.cumsum(raters >= min_raters) - 1
+        entries = np.argsort(columns[self.game_index[shared]], kind="stable")
+        return (columns[self.game_index[shared]][entries],
+                self.rows[shared][entries], self.ratings[shared][entries],
+                int(np.count_nonzero(raters >= min_raters)))
+
+    def all_pairs(self, block_size=4096, dtype=np.float64):
+        """Compare all members with each other using dense matrix
+            products over blocks of games rated by at least two members.
+            Returns: A dict metric -> members x members array
+        """
+        size = len(self.members)
+        game_column, rows, ratings, width = self.shared_columns()
+
+        sums = {name: np.zeros((size, size), dtype=dtype)
+                for name in ("n", "sx", "sxx", "sxy")}
+        for begin in range(0, width, block_size):
+            end = min(begin + block_size, width)
+            lo, hi = np.searchsorted(game_column, [begin, end])
+            block_ratings = np.zeros((size, end - begin), dtype=dtype)
+            block_ratings[rows[lo:hi], game_column[lo:hi] - begin] = \
+                ratings[lo:hi]
+            rated = (block_ratings != 0).astype(dtype)
+            squares = block_ratings * block_ratings
+            sums["n"] += rated @ rated.T
+            sums["sx"] += block_ratings @ rated.T
+            sums["sxx"] += squares @ rated.T
+            sums["sxy"] += block_ratings @ block_ratings.T
+        return metrics(sums["n"], sums["sx"], sums["sx"].T,
+                       sums["sxx"], sums["sxx"].T, sums["sxy"])
+
+    def compare_rows(self, members, block_size=1024, dense_raters=32,
+                     dtype=np.float64):
+        """Compare the members at the indices members with all members
+            like all_pairs, holding only those rows of the sums. Games
+            rated by at least dense_raters members are multiplied in dense
+            blocks, the pairs of ratings of rarer games are summed up
+            directly.
+            Returns: A dict metric -> len(members) x members array
+        """
+        size = len(self.members)
+        sums = {name: np.zeros((len(members), size), dtype=dtype)
+                for name in ("n", "sx", "sy", "sxx", "syy", "sxy")}
+
+        # every rating of the members with all ratings of the same game
+        raters = np.bincount(self.game_index, minlength=len(self.games))
+        rare = (raters >= 2) & (raters < dense_raters)
+        entries = np.flatnonzero(rare[self.game_index])
+        entries = entries[np.argsort(self.game_index[entries],
+                                     kind="stable")]
+        games = self.game_index[entries]
+        rows = self.rows[entries]
+        position = np.full(size, -1)
+        position[members] = np.arange(len(members))
+        own = np.flatnonzero(position[rows] >= 0)
+        counts = raters[games[own]]
+        left = np.repeat(own, counts)
+        right = np.searchsorted(games, games[left]) + (
+            np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts,
+                                             counts))
+        cells = position[rows[left]] * size + rows[right]
+        x = self.ratings[entries[left]]
+        y = self.ratings[entries[right]]
+        for name, weights in (("n", None), ("sx", x), ("sy", y),
+                              ("sxx", x * x), ("syy", y * y),
+                              ("sxy", x * y)):
+            sums[name] += np.bincount(
+                cells, weights=weights, minlength=len(members) * size
+            ).reshape(len(members), size)
+
+        game_column, rows, ratings, width = self.shared_columns(
+            max(dense_raters, 2))
+        for begin in range(0, width, block_size):
+            end = min(begin + block_size, width)
+            lo, hi = np.searchsorted(game_column, [begin, end])
+            block_ratings = np.zeros((size, end - begin), dtype=dtype)
+            block_ratings[rows[lo:hi], game_column[lo:hi] - begin] = \
+                ratings[lo:hi]
+            rated = (block_ratings != 0).astype(dtype)
+            squares = block_ratings * block_ratings
+            own, own_rated = block_ratings[members], rated[members]
+            sums["n"] += own_rated @ rated.T
+            sums["sx"] += own @ rated.T
+            sums["sy"] += own_rated @ block_ratings.T
+            sums["sxx"] += squares[members] @ rated.T
+            sums["syy"] += own_rated @ squares.T
+            sums["sxy"] += own @ block_ratings.T
+        return metrics(sums["n"], sums["sx"], sums["sy"],
+                       sums["sxx"], sums["syy"], sums["sxy"])
+
+    def save_all_pairs(self, filename, **kwargs):
+        """Write the all pairs metrics and the members to a .npz file"""
+        np.savez(filename, members=np.array(self.members),
+                 **self.all_pairs(**kwargs))
+
+
+def load_rating_matrix(member_data_file):
+    """RatingMatrix of a snapshot, memory-mapped, or of other member data
+        files loaded with load_member_data
+    """
+    if member_data_file.endswith(".snap"):
+        return RatingMatrix.from_snapshot(MemberSnapshot(member_data_file))
+    return RatingMatrix.from_dict(load_member_data(member_data_file))
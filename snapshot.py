@@ -0,0 +1,150 @@
+# Compact binary snapshot of member ratings
+#
+# Replaces the member_data_YYYYMMDD.yml dumps. The ratings are stored in
+# compressed sparse rows, one row per member, and read through a memory
+# map without copying:
+#
+#   magic, header length, JSON header with members and array layout,
+#   games: sorted game ids; indptr: start of each member's row;
+#   game_index: index into games per rating; ratings: the ratings
+#
+# BGG ratings have few decimals, so they are stored as small integers
+# times 1 / rating_scale whenever that is exact, else as float64.
+
+import json
+import struct
+
+import numpy as np
+
+from ratings import rating_arrays
+
+MAGIC = b"BGGSNAP1"
+ALIGNMENT = 8
+RATING_SCALES = ((np.uint8, (1, 2, 4, 10, 20)), (np.uint16, (100, 1000)))
+
+
+def encode_ratings(values):
+    """Returns: (ratings, scale) with ratings / scale == values"""
+    for dtype, scales in RATING_SCALES:
+        for scale in scales:
+            scaled = np.rint(values * scale)
+            if np.array_equal(scaled / scale, values):
+                return scaled.astype(dtype), scale
+    return values, 1
+
+
+def rating_rows(member_ratings):
+    """Compressed sparse rows of a dict member -> dict gameid -> rating.
+        Returns: (members, games, indptr, game_index, ratings)
+    """
+    members = list(member_ratings)
+    game_ids, ratings = rating_arrays(member_ratings)
+    games, game_index = np.unique(game_ids, return_inverse=True)
+    indptr = np.zeros(len(members) + 1, dtype=np.int64)
+    np.cumsum([len(member_ratings[x]) for x in members], out=indptr[1:])
+    return members, games, indptr, game_index, ratings
+
+
+def write_snapshot(filename, member_ratings):
+    """Write a dict member -> dict gameid -> rating to filename"""
+    members, games, indptr, game_index, values = rating_rows(member_ratings)
+    index_type = np.uint16 if len(games) <= 1 << 16 else np.uint32
+    ratings, scale = encode_ratings(values)
+    arrays = [("games", games.astype(np.uint32)),
+              ("indptr", indptr),
+              ("game_index", game_index.astype(index_type)),
+              ("ratings", ratings)]
+
+    layout = list()
+    offset = 0
+    for name, array in arrays:
+        layout.append([name, array.dtype.str, offset, len(array)])
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"members": members, "rating_scale": scale,
+                         "arrays": layout}).encode()
+    start = len(MAGIC) + 8 + len(header)
+    padding = -start % ALIGNMENT
+    with open(filename, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(struct.pack("<Q", len(header) + padding))
+        fo.write(header + b" " * padding)
+        for name, array in arrays:
+            fo.write(array.tobytes())
+            fo.write(b"\0" * (-array.nbytes % ALIGNMENT))
+
+
+class MemberSnapshot:
+    """Memory-mapped snapshot written by write_snapshot"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        raw = np.memmap(filename, dtype=np.uint8, mode="r")
+        if bytes(raw[:len(MAGIC)]) != MAGIC:
+            raise ValueError(filename + " is no member ratings snapshot")
+        size = struct.unpack("<Q", bytes(raw[len(MAGIC):len(MAGIC) + 8]))[0]
+        start = len(MAGIC) + 8
+        header = json.loads(bytes(raw[start:start + size]))
+        start += size
+        self.members = header["members"]
+        self.rating_scale = header["rating_scale"]
+        self.member_index = {x: i for i, x in enumerate(self.members)}
+        for name, dtype, offset, length in header["arrays"]:
+            dtype = np.dtype(dtype)
+            begin = start + offset
+            setattr(self, name,
+                    raw[begin:begin + length * dtype.itemsize].view(dtype))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.member_index
+
+    def rating_values(self, start=0, stop=None):
+        """Returns: The ratings from start to stop as float64 array"""
+        return self.ratings[start:stop] / self.rating_scale
+
+    def ratings_for(self, member):
+        """Returns: A dict gameid -> rating of member"""
+        i = self.member_index[member]
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return dict(zip(self.games[self.game_index[start:stop]].tolist(),
+                        self.rating_values(start, stop).tolist()))
+
+    def to_dict(self):
+        """Returns: A dict member -> dict gameid -> rating"""
+        return {x: self.ratings_for(x) for x in self.members}
+
+
+def load_member_data(filename):
+    """Load member ratings from a snapshot, a checkpoint (.jsonl) or a
+        former YAML dump.
+        Returns: A dict member -> dict gameid -> rating
+    """
+    if filename.endswith((".yml", ".yaml")):
+        import yaml
+        with open(filename, "r") as data_file:
+            return yaml.safe_load(data_file)
+    if filename.endswith(".jsonl"):
+        from checkpoint import RatingCheckpoint
+        return RatingCheckpoint(filename).load()
+    return MemberSnapshot(filename).to_dict()
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(
+        description="Convert member data to a snapshot")
+    parser.add_argument(
+        "filename",
+        help="member_data_YYYYMMDD.yml or member_data_YYYYMMDD.jsonl")
+    parser.add_argument(
+        "-o", "--output",
+        help="snapshot file, default: FILENAME with extension .snap")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.filename)[0] + ".snap"
+    write_snapshot(output, load_member_data(args.filename))
+    print("Wrote", output)